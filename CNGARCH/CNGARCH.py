@@ -13,7 +13,11 @@
 
 # TODO : GENERAL beef up all the __str__
 
-from numba import njit
+from numba import njit, prange
+from numba.core import event
+# every kernel is compiled with cache=True: the machine code is stored next to this file (or in numba's cache
+# directory when it is read-only), so new processes and pool workers load it instead of compiling again
+# and with nogil=True: the kernels release the GIL, so the threads of an EstimationThreadPool run them concurrently
 
 from math import pi
 import warnings
@@ -21,15 +25,27 @@ import warnings
 import numpy as np
 from numpy import ndarray, sqrt
 from numpy import linalg as LA
-from scipy.optimize import basinhopping, minimize
 import multiprocessing as mp
-from copy import deepcopy
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
+from contextlib import nullcontext
+import hashlib
 import time
 
 
 # TODO include estimation time series, and filter time series.
-# TODO include a simulation method, to be hooked in the LSMC block.
+# TODO hook simulate() in the LSMC block.
 class gmodel:
+    # number of variance components carried in vpath/qpath
+    _components = 1
+    # positions in _natural() of the parameters of the score gradient, None when it is the whole natural vector
+    _gradientindex = None
+    # variance targeting: sigma is the sample standard deviation of R and is left out of x
+    _targetV = False
+    # kurtosis targeting: alpha_1 gives the model the kurtosis targetK (the sample kurtosis of R when True) and is
+    # left out of x
+    _targetK = False
+
     def __init__(self, x:list[float], R:np.ndarray=np.zeros((1,))) -> None:
         self._x = x
         self._R = R
@@ -52,13 +68,30 @@ class gmodel:
         self._debug = False
         self._bounds = None
         self._estimationtime = -1.0
+        # telemetry of the last estimate(), or of every start of the last parallel()
+        self.stats = EstimationStats()
+        # an EstimationCache: estimate() and parallel() read the results of identical estimations from it
+        self.cache = None
         self._multix = x
+        # warm start: previous inverse-Hessian approximation and a budget tuned for small daily moves
+        self._hessinv = None
+        self._warmoptions = {'ftol':1e-10, 'gtol': 1e-12, 'disp': False, 'eps': 1e-8, 'maxcor':30, 'maxiter':200}
+        # online update: last filtered innovation and the buffers R and the paths grow into
+        self._zlast = None
+        self._Rbuffer = np.zeros((0,), dtype=float)
+        self._pathbuffer = np.zeros((0,0), dtype=float)
+        # scratch arrays of the estimation path, see _workspace
+        self._work = np.zeros((4,0), dtype=float)
+        # sample moments of R for the targets, see _sample
+        self._samplefor = None
+        self._samplemoments = (0.0, 0.0)
 
     def __str__(self) -> str:
         return "General GARCH Model\n"
 
     def set_theta(self, x):
         self._x = x
+        self._zlast = None
 
     @property
     def x(self):
@@ -76,10 +109,18 @@ class gmodel:
     def OptimizationBounds(self):
         return self._bounds
 
+    @property
+    def WarmStartOptions(self):
+        return self._warmoptions
+
     @R.setter
     def R(self, value):
         # TODO make sure the format of the vector is appropriate
         self._R = value.flatten()
+        self._zlast = None
+        if self._targetV or self._targetK is True:
+            # the targets follow the sample moments of the new R
+            self.set_theta(self._x)
 
     @OptimizationOptions.setter
     def OptimizationOptions(self, value):
@@ -89,22 +130,373 @@ class gmodel:
     def OptimizationBounds(self, value):
         self._bounds = value
 
+    @WarmStartOptions.setter
+    def WarmStartOptions(self, value):
+        self._warmoptions = value
+
     def _pen(self,theta_check):
+        # the linear term keeps the optimum inside the constraints, the penalty is still continuous at 0
         if theta_check<0:
             penalty = 0
         else:
-            penalty = self._PenK*theta_check**3
+            penalty = self._PenK*(theta_check + theta_check**3)
         return penalty
 
     def _penalty_constraints(self):
         pass
 
+    def _natural(self):
+        pass
+
+    def _specification(self)->dict:
+        # keyword arguments of the constructor besides x and R
+        return {}
+
+    def _dpen(self,theta_check):
+        # derivative of _pen with respect to theta_check
+        if theta_check<0:
+            return 0.0
+        return self._PenK*(1 + 3*theta_check**2)
+
+    def _penalty_gradient(self):
+        pass
+
+    def _sample(self):
+        # (standard deviation, kurtosis) of R, computed again only when R changes
+        if self._samplefor is not self._R:
+            R = self._R - np.mean(self._R)
+            var = np.mean(R*R)
+            # a constant series (the default R) has no kurtosis, the normal one is used
+            self._samplemoments = (sqrt(var), np.mean(R**4)/(var*var) if var>0 else 3.0)
+            self._samplefor = self._R
+        return self._samplemoments
+
+    def _targeted(self, x):
+        # full x from the reduced x of the optimizer: sigma from R with targetV, alpha_1 a placeholder with targetK
+        # until _targetalpha solves it from the other parameters
+        x = np.array(x, dtype=float)
+        if self._targetV:
+            x = np.insert(x, 1, self._sample()[0])
+        if self._targetK:
+            x = np.insert(x, 3, 0.0)
+        return x
+
+    def _targetalpha(self):
+        # alpha_1 of the target kurtosis, the largest root of A*alpha_1^2 + B*alpha_1 + C = 1 - 3/kurtosis.
+        # Out of reach (target <= 3, non-stationary persistences) it is negative or 0 and the constraints penalize it
+        kurtosis = self._sample()[1] if self._targetK is True else float(self._targetK)
+        try:
+            A, B, C = _kurtosisterms(self._kernelnatural())
+        except LA.LinAlgError:
+            return 0.0
+        if not A>0 or not kurtosis>0:
+            return 0.0
+        return (-B + sqrt(max(B*B - 4*A*(C - 1 + 3/kurtosis), 0.0)))/(2*A)
+
+    def _targetgradient(self, grad):
+        # gradient w.r.t. the full x mapped to the reduced x of the optimizer, sigma from R does not move with x
+        if self._targetK:
+            # implicit derivative of alpha_1: dF + (2*A*alpha_1 + B)*d(alpha_1) = 0 with F as in _kurtosisterms,
+            # dF by central differences of the small moment system
+            natural = self._kernelnatural()
+            A, B, C = _kurtosisterms(natural)
+            dF = np.zeros_like(natural)
+            for j in range(2, len(natural)):
+                if j==3:
+                    continue
+                h = 1E-7*max(1.0, abs(natural[j]))
+                up, down = natural.copy(), natural.copy()
+                up[j] += h
+                down[j] -= h
+                Fup = np.dot(_kurtosisterms(up), [natural[3]**2, natural[3], 1])
+                Fdown = np.dot(_kurtosisterms(down), [natural[3]**2, natural[3], 1])
+                dF[j] = (Fup - Fdown)/(2*h)
+            # at the vertex (target out of reach) alpha_1 is held and only the penalty moves
+            slope = 2*A*natural[3] + B
+            dalpha = -dF/slope if slope>0 else np.zeros_like(dF)
+            if self._gradientindex is not None:
+                dalpha = dalpha[list(self._gradientindex)]
+            grad = np.delete(grad + grad[3]*self._chaingradient(dalpha), 3)
+        if self._targetV:
+            grad = np.delete(grad, 1)
+        return grad
+
+    def _targetlabel(self)->str:
+        # suffix of glabel for the targets
+        label = ''
+        if self._targetV:
+            label = label + '-VT'
+        if self._targetK:
+            label = label + f"-KTE-{self._targetK}"
+        return label
+
+    def _targetdescription(self)->str:
+        # suffix of the model line of __str__ for the targets
+        text = ''
+        if self._targetV:
+            text = text + f" with variance targetting at sigma = {self._sample()[0]}"
+        if self._targetK:
+            kurtosis = self._sample()[1] if self._targetK is True else self._targetK
+            text = text + f" with kurtosis targetting at {kurtosis}"
+        return text
+
+    def _variance_penalty(self):
+        # penalty, and its gradient, when the starting variance is not positive
+        x = np.array(self.x, dtype=float)
+        norm = LA.norm(x)
+        return 9999*norm, 9999*x/norm
+
     def filter(self, output="variance", debug=False):
         pass
 
-    def forecast(self, kdays:int)->np.ndarray:
+    def _score(self, vpath, qpath, W, Z, N):
+        # (negative log-likelihood, gradient w.r.t. the model's natural parameters, variance-bound penalty)
+        # from the score kernel
         pass
 
+    def _chaingradient(self, grad):
+        return grad
+
+    def _kernelnatural(self):
+        # natural parameters of the recursion kernels, 2 + 3*K of them for K components
+        return self._natural()[:2 + 3*self._components]
+
+    def _componentpaths(self)->list:
+        # the filtered path of every component, the variance first
+        return [self.vpath, self.qpath][:self._components]
+
+    def _setcomponentpaths(self, paths:np.ndarray):
+        self.vpath = paths[0]
+        if self._components==2:
+            self.qpath = paths[1]
+
+    def _workspace(self, N:int):
+        # vpath, qpath, W, Z scratch arrays of the score kernels, reused while the length of R does not change
+        if np.size(self._work,1)!=N:
+            self._work = np.zeros((4,N), dtype=float)
+        return self._work[0], self._work[1], self._work[2], self._work[3]
+
+    def _objective(self, output, penalty):
+        # filter(output='estimate' or 'gradient'): the objective of the optimizers, no path is kept
+        stats = self.stats
+        stats.nfev += 1
+        if penalty>0:
+            stats.constrainthits += 1
+        var = self._sg*self._sg
+        if var<1E-6:
+            stats.variancehits += 1
+            if output=='estimate':
+                return 9999*LA.norm(self.x)
+            return self._variance_penalty()
+
+        N = len(self._R)
+        if output=='estimate':
+            start = time.perf_counter()
+            LL, bound = _numbaloglikelihood(self._R, self._kernelnatural(), N)
+            stats.kerneltime += time.perf_counter() - start
+            if bound>0:
+                stats.boundhits += 1
+            self.loglikelihood = LL
+            return LL + penalty
+
+        vpath, qpath, W, Z = self._workspace(N)
+        vpath[0] = var
+        qpath[0] = var
+        W[0] = self._R[0] - self._la*sqrt(var) + 0.5*var
+        Z[0] = W[0] / sqrt(var)
+        start = time.perf_counter()
+        LL, grad, bound = self._score(vpath, qpath, W, Z, N)
+        stats.kerneltime += time.perf_counter() - start
+        if bound>0:
+            stats.boundhits += 1
+        self.loglikelihood = LL
+        if penalty>0:
+            return LL + penalty, self._targetgradient(self._chaingradient(grad + self._penalty_gradient()))
+        return LL, self._targetgradient(self._chaingradient(grad))
+
+    def forecast(self, kdays:int)->np.ndarray:
+        # vforecast (and qforecast) for the days 0..kdays after the last filtered day, see termstructure()
+        if self._zlast is None or not self.vpath[-1]>0:
+            self.filter()
+        horizons = np.arange(kdays+1)
+        self.vforecast, cumulative = self.termstructure(horizons)
+        if self._components==2:
+            var = self._sg*self._sg
+            self.qforecast = var + self._natural()[5]**horizons*(self.qpath[-1] - var)
+            # component forecasts are floored at 1E-6
+            self.vforecast[1:] = np.maximum(self.vforecast[1:], 1E-6)
+            self.qforecast[1:] = np.maximum(self.qforecast[1:], 1E-6)
+
+    def simulate(self, n_paths:int, horizon:int, seed=None):
+        """
+            Monte Carlo paths of the model from theta and the last filtered day (filtered first if needed).
+            Returns (returns, variances, components), each shaped (n_paths, horizon), components is None for the
+            one-component models and shaped (K-1, n_paths, horizon) beyond two components. The draws are made with
+            np.random.default_rng(seed) into the returns array, which the compiled kernel then turns into returns in
+            place, one path per thread.
+        """
+        if self._zlast is None or not self.vpath[-1]>0:
+            self.filter()
+        returns = np.empty((n_paths, horizon), dtype=float)
+        np.random.default_rng(seed).standard_normal(out=returns)
+        paths = np.empty((self._components, n_paths, horizon), dtype=float)
+        c0 = np.array([path[-1] for path in self._componentpaths()], dtype=float)
+        _numbasimulate(self._kernelnatural(), c0, self._zlast, returns, paths)
+        if self._components==1:
+            return returns, paths[0], None
+        if self._components==2:
+            return returns, paths[0], paths[1]
+        return returns, paths[0], paths[1:]
+
+    def termstructure(self, horizons, vstart=None, qstart=None):
+        """
+            Closed-form variance forecasts for every horizon in one call, returns (point, cumulative) where
+            point[h] is the variance h days ahead (point[0] is the starting variance, as in vforecast) and
+            cumulative[h] = point[0] + ... + point[h-1], the total variance over the next h days.
+            vstart and qstart default to the last filtered day. Give whole paths (vpath, qpath) to forecast from
+            every day at once, the outputs are then shaped (len(vstart), len(horizons)).
+        """
+        natural = self._natural()
+        var = natural[1]*natural[1]
+        if vstart is None:
+            vstart = self.vpath[-1]
+            if self._components==2:
+                qstart = self.qpath[-1]
+        if qstart is None:
+            qstart = var
+        single = np.ndim(vstart)==0
+        v0 = np.atleast_1d(np.asarray(vstart, dtype=float))[:,None]
+        q0 = np.broadcast_to(np.atleast_1d(np.asarray(qstart, dtype=float))[:,None], v0.shape)
+        point, cumulative = _termstructure(var, natural[2], natural[5], v0, q0, np.asarray(horizons, dtype=float)[None,:])
+        if single:
+            return point[0,:], cumulative[0,:]
+        return point, cumulative
+
+    def _termstructureat(self, horizons, days):
+        # termstructure() from the filtered state of every day in days at once, outputs shaped (len(days), len(horizons))
+        return self.termstructure(horizons, *[path[days] for path in self._componentpaths()])
+
+    def update(self, newreturns)->float:
+        """
+            Append newreturns to R and continue the filter from the last filtered day, without refiltering the history.
+            vpath (and qpath) and the log-likelihood are extended; R and the paths live in buffers that double when
+            full, so adding a day is O(1) amortized. Without a filtered state for the current theta and R, the whole
+            series is filtered instead. Returns the log-likelihood.
+        """
+        newreturns = np.asarray(newreturns, dtype=float).flatten()
+        N = len(self._R)
+        n = N + len(newreturns)
+        filtered = self._zlast is not None and len(self.vpath)==N and self.vpath[-1]>0
+
+        self._Rbuffer = _growbuffer(self._Rbuffer, self._R, n)
+        self._Rbuffer[N:n] = newreturns
+        self._R = self._Rbuffer[:n]
+        if not filtered:
+            self.filter()
+            return self.loglikelihood
+
+        self._pathbuffer = _growpaths(self._pathbuffer, self._componentpaths(), n)
+        LL, self._zlast = _numbaupdate(self._Rbuffer, self._pathbuffer, self._kernelnatural(), self._zlast, N, n)
+        self._setcomponentpaths(self._pathbuffer[:,:n])
+        self.loglikelihood = self.loglikelihood + LL
+        return self.loglikelihood
+
+    def scores(self)->np.ndarray:
+        """
+            Per-observation scores at theta, shaped (len(R), len(x)): row t is the gradient w.r.t. x of the
+            log-likelihood of day t. One pass of the score kernel, the rows sum to minus the gradient of
+            filter(output='gradient') (without the constraint penalties).
+        """
+        N = len(self._R)
+        natural = self._kernelnatural()
+        var = natural[1]*natural[1]
+        paths = np.zeros((self._components, N), dtype=float)
+        paths[:,0] = var
+        W = np.zeros((N,), dtype=float)
+        Z = np.zeros((N,), dtype=float)
+        W[0] = self._R[0] - natural[0]*sqrt(var) + 0.5*var
+        Z[0] = W[0] / sqrt(var)
+        scores = np.zeros((N, len(natural)), dtype=float)
+        _numbascore(self._R, paths, W, Z, natural, N, scores)
+        if self._gradientindex is not None:
+            scores = scores[:,list(self._gradientindex)]
+        # the map from the natural parameters to x is linear in the gradient: applied once to the identity
+        jacobian = np.array([self._targetgradient(self._chaingradient(row)) for row in np.eye(np.size(scores,1))])
+        return -scores @ jacobian
+
+    def covariance(self, method='qml')->np.ndarray:
+        """
+            Covariance matrix of the estimate x (theta should be the estimate):
+            'opg' the inverse of the outer product of the scores, B = S'S,
+            'qml' the sandwich H^-1 B H^-1 of quasi-maximum likelihood, robust to non-normal innovations. The Hessian H
+            is the central differences of the summed scores, 2*len(x) more passes of the score kernel.
+        """
+        S = self.scores()
+        B = S.T @ S
+        if method=='opg':
+            return LA.inv(B)
+        if method!='qml':
+            raise Exception(f"Unknown method {method}, use 'opg' or 'qml'.")
+        x = np.array(self.x, dtype=float)
+        model = gmodel.from_state(self.to_state(), self._R)
+        H = np.zeros((len(x), len(x)), dtype=float)
+        for idx in range(len(x)):
+            h = 1E-5*max(1.0, abs(x[idx]))
+            up, down = x.copy(), x.copy()
+            up[idx] += h
+            down[idx] -= h
+            model.set_theta(up)
+            gup = np.sum(model.scores(), axis=0)
+            model.set_theta(down)
+            gdown = np.sum(model.scores(), axis=0)
+            H[:,idx] = (gup - gdown)/(2*h)
+        Hinv = LA.inv(0.5*(H + H.T))
+        return Hinv @ B @ Hinv
+
+    def standarderrors(self, method='qml')->np.ndarray:
+        # standard errors of x, see covariance()
+        return np.sqrt(np.diag(self.covariance(method)))
+
+    def to_state(self, theta=None):
+        """
+            The ModelState of the model: what it takes to rebuild it on a return series with gmodel.from_state().
+            With theta, the state of a new start from theta (no inverse-Hessian or estimate).
+        """
+        state = ModelState()
+        state.modeltype = type(self)
+        state.specification = self._specification()
+        state.bounds = self._bounds
+        state.options = self._optimizeoptions
+        state.warmoptions = self._warmoptions
+        if theta is None:
+            state.theta = np.array(self.x, dtype=float)
+            state.hessinv = None if self._hessinv is None else np.array(self._hessinv, dtype=float)
+            state.loglikelihood = float(self.loglikelihood)
+            state.success = bool(self.success)
+        else:
+            state.theta = np.array(theta, dtype=float)
+            state.hessinv = None
+            state.loglikelihood = 0.0
+            state.success = False
+        return state
+
+    @staticmethod
+    def from_state(state, R:np.ndarray=np.zeros((1,))):
+        # a model of the class and specification of state on R, in the state of state (not filtered)
+        model = state.modeltype(np.array(state.theta, dtype=float), R, **state.specification)
+        model.set_state(state)
+        return model
+
+    def set_state(self, state):
+        # theta, bounds, options, inverse-Hessian and estimate of state, the class and specification are not checked
+        self.set_theta(np.array(state.theta, dtype=float))
+        self._bounds = state.bounds
+        self._optimizeoptions = state.options
+        self._warmoptions = state.warmoptions
+        self._hessinv = None if state.hessinv is None else np.array(state.hessinv, dtype=float)
+        self.loglikelihood = state.loglikelihood
+        self.success = state.success
+
     def genrandomthetas(self, thetarange:tuple, n: int, seed: int = 1):
         size = len(thetarange)
         rng = np.random.default_rng(seed)
@@ -118,16 +510,52 @@ class gmodel:
         return theta
 
 
-    def estimate(self, optimizer='minimize', nbhopping=10):
-        # optimizer='minimize' or 'basinhopping'
+    def estimate(self, optimizer='minimize', nbhopping=10, gradient=True):
+        # optimizer='minimize', 'basinhopping' or 'warmstart' (falls back to 'minimize' without a previous estimate)
+        # gradient=True uses the analytic score from the filter kernels, gradient=False finite differences.
+        # Every call starts a new self.stats, see EstimationStats
+        # With self.cache, a hit skips the optimizer and a miss is stored once estimated
+        self.stats = EstimationStats(1)
+        start = time.perf_counter()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self, optimizer, nbhopping, gradient)
+            if self.cache.restore(key, self):
+                self.stats.cachehits = 1
+                self.stats.totaltime = time.perf_counter() - start
+                return
+        with event.install_timer('numba:compile', self.stats._compiled):
+            self._estimate(optimizer, nbhopping, gradient)
+        if key is not None:
+            self.cache.store(key, self.x, self.loglikelihood, self.success, self._hessinv)
+        self.stats.totaltime = time.perf_counter() - start
+
+    def _estimate(self, optimizer, nbhopping, gradient):
+        # scipy is only imported by the first estimation
+        from scipy.optimize import basinhopping, minimize
+        if gradient:
+            objective, jac = _optimizegradient, True
+        else:
+            objective, jac = _optimize, None
+        if optimizer=='warmstart':
+            if self._hessinv is None or np.shape(self._hessinv)!=(len(self.x), len(self.x)):
+                optimizer = 'minimize'
+            else:
+                self._warmestimate()
+                if self.success:
+                    return
+                optimizer = 'minimize'
+
         if optimizer=='minimize':
             args = (self)
             try:
-                theta_hat = minimize(_optimize, self.x, args, method='L-BFGS-B', options=self._optimizeoptions, bounds=self._bounds)            
+                theta_hat = minimize(objective, self.x, args, method='L-BFGS-B', jac=jac, options=self._optimizeoptions, bounds=self._bounds)            
             except ValueError:
-                theta_hat = minimize(_optimize, self.x, args, method='L-BFGS-B', options=self._optimizeoptions)
+                theta_hat = minimize(objective, self.x, args, method='L-BFGS-B', jac=jac, options=self._optimizeoptions)
                 
             self.scipyresult = theta_hat
+            self.stats.nit += theta_hat.nit
+            self._hessinv = theta_hat.hess_inv.todense()
             if theta_hat['success']:
                 self.set_theta(theta_hat['x'])
                 self.loglikelihood = theta_hat['fun']
@@ -136,8 +564,9 @@ class gmodel:
                 self.success=False
 
         elif optimizer=='basinhopping':
-            args = {'method': 'L-BFGS-B', 'args': self}
-            theta_hat = basinhopping(_optimize, self.x, niter=nbhopping, T=0.20, stepsize=0.005, minimizer_kwargs=args, seed=1)
+            args = {'method': 'L-BFGS-B', 'args': self, 'jac': jac}
+            theta_hat = basinhopping(objective, self.x, niter=nbhopping, T=0.20, stepsize=0.005, minimizer_kwargs=args, seed=1)
+            self.stats.nit += theta_hat.nit
             # TODO make sure the optimization was successful
             self.set_theta(theta_hat['x'])
             self.success=True
@@ -148,6 +577,36 @@ class gmodel:
             done_tf = 1
 
 
+    def _warmestimate(self):
+        """
+            Re-estimate starting from the current theta, typically yesterday's optimum.
+            The variables are rescaled by the square root of the diagonal of the previous inverse-Hessian
+            approximation, which hands its curvature to L-BFGS-B while keeping the box bounds.
+        """
+        from scipy.optimize import minimize
+        x0 = np.array(self.x, dtype=float)
+        scale = np.sqrt(np.clip(np.diag(self._hessinv), 1E-12, None))
+        bounds = None
+        if self._bounds is not None:
+            bounds = []
+            for idx, (low, high) in enumerate(self._bounds):
+                bounds.append((None if low is None else (low - x0[idx])/scale[idx],
+                               None if high is None else (high - x0[idx])/scale[idx]))
+
+        theta_hat = minimize(_optimizescaled, np.zeros_like(x0), (x0, scale, self), method='L-BFGS-B', jac=True, options=self._warmoptions, bounds=bounds)
+
+        self.scipyresult = theta_hat
+        self.stats.nit += theta_hat.nit
+        if theta_hat['success']:
+            self._hessinv = scale[:,None] * theta_hat.hess_inv.todense() * scale[None,:]
+            self.set_theta(x0 + scale*theta_hat['x'])
+            self.loglikelihood = theta_hat['fun']
+            self.success=True
+        else:
+            self.set_theta(x0)
+            self.success=False
+
+
     def fullestimate(self, nbhopping=10):
         self.estimate()
         if self.success:
@@ -163,186 +622,696 @@ class gmodel:
             return False
 
 
-    def parallel(self, thetas=None, Ncores=4, estpool=None):
+    def screenthetas(self, thetas=None)->np.ndarray:
+        """
+            Evaluate the objective (negative log-likelihood) of every row of thetas in one batched kernel call.
+            Sets of parameters that break the constraints get np.inf.
+        """
         if thetas is None:
             thetas = self._multix
+        thetas = np.atleast_2d(thetas)
         nbest = np.size(thetas,0)
-        thetaout = np.ones_like(thetas)
-        timers   = np.zeros((nbest,), dtype=float)
-        worked = [None]*nbest
-        alltests = [None]*nbest
-        for iest in range(nbest):
-            alltests[iest] = deepcopy(self)
-            alltests[iest].set_theta(thetas[iest,:])
-            # alltests[iest].fullestimate()
-
-        # output = alltests
-        if estpool is None:
-            estpool = mp.Pool(Ncores)
-
-        output = estpool.map(_paralelle, alltests)
-
-        # process_pool.close()
-
-        
-        best = np.zeros((nbest,))
+        x0 = self.x
+        natural = np.zeros((nbest, len(self._kernelnatural())), dtype=float)
+        valid = np.ones((nbest,), dtype=np.bool_)
         for iest in range(nbest):
-            best[iest] = output[iest].loglikelihood
-            thetaout[iest,:] = output[iest].x
-            timers[iest] = output[iest]._estimationtime
-            worked[iest] = output[iest].success
-
-
+            self.set_theta(thetas[iest,:])
+            valid[iest] = not self._penalty_constraints()>0
+            natural[iest,:] = self._kernelnatural()
+        self.set_theta(x0)
+
+        scores = _numbabatchll(self._R, natural, len(self._R))
+        scores[~valid] = np.inf
+        return scores
+
+
+    def parallel(self, thetas=None, Ncores=4, estpool=None, nscreen=None, agree=None, tolerance=1E-3, deadline=None,
+                 backend='process'):
+        # nscreen: when given, every start is scored with screenthetas() and only the nscreen best are optimized
+        # estpool: an EstimationPool, or any pool with map(); without one a temporary pool of Ncores is used,
+        # processes (EstimationPool) or threads (EstimationThreadPool) as backend='process' or 'thread'
+        # agree, tolerance, deadline: race the starts, stop once agree successful starts are within tolerance of the
+        # best log-likelihood or after deadline seconds, see EstimationPool.race (other pools need imap_unordered())
+        if thetas is None:
+            thetas = self._multix
+        thetas = np.atleast_2d(thetas)
+        if nscreen is not None and nscreen<np.size(thetas,0):
+            scores = self.screenthetas(thetas)
+            thetas = thetas[np.argsort(scores, kind='stable')[:nscreen],:]
+        nbest = np.size(thetas,0)
+        racing = agree is not None or deadline is not None
+
+        # the starts found in self.cache are not sent to the pool
+        found, keys = {}, {}
+        if self.cache is not None:
+            for iest in range(nbest):
+                keys[iest] = self.cache.key(self, theta=thetas[iest,:])
+                hit = self.cache.lookup(keys[iest])
+                if hit is not None:
+                    hitstats = EstimationStats(1)
+                    hitstats.cachehits = 1
+                    found[iest] = (hit[0], hit[1], hit[2], 0.0, hit[3], hitstats)
+        todo = np.array([iest for iest in range(nbest) if iest not in found], dtype=int)
+        if len(todo)>0:
+            if estpool is None or isinstance(estpool, EstimationPool):
+                with (_estimationpool(Ncores, backend) if estpool is None else nullcontext(estpool)) as pool:
+                    if racing:
+                        output = pool.race(self, thetas[todo,:], agree, tolerance, deadline)
+                        indices, output = todo[output[0]], output[1:]
+                    else:
+                        indices, output = todo, pool.estimate(self, thetas[todo,:])
+            else:
+                # any other pool gets the series with the ModelState of every start
+                start = time.perf_counter()
+                tasks = [(iest, self.to_state(thetas[iest,:]), self._R) for iest in todo]
+                if racing:
+                    output = _race(estpool.imap_unordered(_statestart, tasks), len(todo), agree, tolerance, deadline, start)
+                else:
+                    output = dict(estpool.map(_statestart, tasks))
+                output = _raceresults(output)
+                indices, output = output[0], output[1:]
+            for position, iest in enumerate(indices):
+                found[iest] = tuple(out[position] for out in output)
+                if self.cache is not None:
+                    self.cache.store(keys[iest], *found[iest][:3], found[iest][4])
+        finished, thetaout, best, worked, timers, hessinvs, stats = _raceresults(found)
+
+        if len(best)==0 or np.all(np.isnan(best)):
+            warnings.warn('No start finished before the deadline, theta is unchanged')
+            self.stats = sum(stats, EstimationStats())
+            self.success = False
+            return
         bestindex = np.nanargmin(best)
-        self.set_theta(output[bestindex].x)
-        self.success = output[bestindex].success
+        self.stats = sum(stats, EstimationStats())
+        self.set_theta(thetaout[bestindex,:])
+        self.success = worked[bestindex]
+        self._hessinv = hessinvs[bestindex]
         self.filter()
 
         # doneparalelle = 1
 
 
 
-@njit
-def _numbafiltergarch(_R, vpath, W, Z, _la, _p1, _a1, N):
-    penalty = False
+@njit(cache=True, nogil=True)
+def _boundvariance(v):
+    # Variances are kept in [1E-6, 1]. Outside, the variance is clamped and a smooth penalty is charged so the
+    # objective stays continuous in the parameters.
+    # returns (bounded variance, penalty, d penalty / dv, d bounded variance / dv)
+    if v<1E-6:
+        rel = (1E-6 - v)/1E-2
+        return 1E-6, 9999.0*rel*rel, -2*9999.0*rel/1E-2, 0.0
+    elif v>1:
+        return 1.0, 9999.0*(v - 1)*(v - 1), 2*9999.0*(v - 1), 0.0
+    return v, 0.0, 0.0, 1.0
+
+
+# The kernels below run the recursion of K nested components for the natural parameters
+# [lambda, sigma, pers_1, alpha_1, gamma_1, ..., pers_K, alpha_K, gamma_K], K = (len(natural) - 2)//3.
+# Component K (the longest) reverts to the variance sigma^2 and every shorter component k to component k+1,
+# component 1 is the variance of the returns:
+#   c_K,t = sigma^2 + pers_K*(c_K,t-1 - sigma^2)     + alpha_K*v_t-1*(Z^2 - 1 - 2*gamma_K*Z)
+#   c_k,t = c_k+1,t + pers_k*(c_k,t-1 - c_k+1,t-1) + alpha_k*v_t-1*(Z^2 - 1 - 2*gamma_k*Z)
+# garch and ngarch are K=1, cgarch and cngarch K=2 (gamma=0 for the symmetric ones), kngarch any K.
+@njit(cache=True, nogil=True)
+def _numbafilter(_R, paths, W, Z, natural, N):
+    # paths[k,:] is component k+1 (paths[0,:] the variance), column 0 and W[0], Z[0] are set by the caller.
+    # Fills paths, W and Z, returns the negative log-likelihood
+    K = paths.shape[0]
+    _la = natural[0]
+    var = paths[0,0]
+    vpath = paths[0,:]
+    penalty = 0.0
     for t in range(1,N):
-        vpath[t] = (vpath[0]) + _p1*(vpath[t-1] - vpath[0]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
-        if (vpath[t]<=1E-6 or vpath[t]>1):
-            LL = 9999.0*(_p1+_a1)**2
-            penalty = True
-            break
+        nxt = var
+        older = var
+        day = 0.0
+        for k in range(K-1, -1, -1):
+            raw = (nxt) + natural[2+3*k]*(paths[k,t-1] - older) + natural[3+3*k]*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*natural[4+3*k]*Z[t-1])
+            paths[k,t], pen, dpen, dcl = _boundvariance(raw)
+            day += pen
+            nxt = paths[k,t]
+            older = paths[k,t-1]
+        penalty += day
 
         W[t] = (_R[t] - _la*sqrt(vpath[t]) + 0.5*vpath[t])
         Z[t] = W[t] / sqrt(vpath[t])
 
-    if not penalty:
-        objective = -0.5 *( np.log(2*pi) + np.log(vpath) + np.divide(np.multiply(W,W),vpath) )
-        LL = -np.sum(objective)
+    objective = -0.5 *( np.log(2*pi) + np.log(vpath) + np.divide(np.multiply(W,W),vpath) )
+    LL = -np.sum(objective) + penalty
 
-    return LL, vpath
+    return LL
 
 
-@njit
-def _numbafilterngarch(_R, vpath, W, Z, _la, _p1, _a1, _g1, N):
-    penalty = False
+@njit(cache=True, nogil=True)
+def _numbastep(natural, c, z, var):
+    # one day of the recursion on the state c (c[0] the variance) after the innovation z, in place.
+    # Returns the penalty of the variance bounds
+    K = c.shape[0]
+    v = c[0]
+    nxt = var
+    older = var
+    day = 0.0
+    for k in range(K-1, -1, -1):
+        old = c[k]
+        c[k], pen, dpen, dcl = _boundvariance((nxt) + natural[2+3*k]*(old - older) + natural[3+3*k]*v*(z*z - 1 - 2*natural[4+3*k]*z))
+        day += pen
+        nxt = c[k]
+        older = old
+    return day
+
+
+# The score kernels run the same recursion as the filter kernels above and carry the derivatives
+# of v, q and Z with respect to the natural parameters along, so the gradient of the negative
+# log-likelihood comes out of the same pass.
+# d(ll_t) = 0.5*dv/v*(1 - Z^2) + Z*dW/sqrt(v)
+@njit(cache=True, nogil=True)
+def _numbascoregarch(_R, vpath, W, Z, _la, _sg, _p1, _a1, N):
+    # natural parameters: [lambda, sigma, persistence, alpha]
+    K = 4
+    grad = np.zeros((K,), dtype=float)
+    dv = np.zeros((K,), dtype=float)
+    dZ = np.zeros((K,), dtype=float)
+    var = vpath[0]
+    dvar = 2*_sg
+
+    sv = sqrt(vpath[0])
+    dv[1] = dvar
+    for k in range(K):
+        dW = (0.5 - 0.5*_la/sv)*dv[k]
+        if k==0:
+            dW = dW - sv
+        dZ[k] = dW/sv - 0.5*Z[0]*dv[k]/vpath[0]
+        grad[k] += 0.5*dv[k]/vpath[0]*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+
+    LL = 0.5*(np.log(2*pi) + np.log(vpath[0]) + W[0]*W[0]/vpath[0])
+    penalty = 0.0
     for t in range(1,N):
-        vpath[t] = (vpath[0]) + _p1*(vpath[t-1] - vpath[0]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g1*Z[t-1])
-        if (vpath[t]<=1E-6 or vpath[t]>1):
-            LL = 9999.0*(_p1+_a1+_g1)**2
-            penalty = True
-            break
+        vp = vpath[t-1]
+        zp = Z[t-1]
+        e1 = zp*zp - 1
+        vraw = (vpath[0]) + _p1*(vpath[t-1] - vpath[0]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
+        vpath[t], penv, dpenv, dclv = _boundvariance(vraw)
+        penalty += penv
 
         W[t] = (_R[t] - _la*sqrt(vpath[t]) + 0.5*vpath[t])
         Z[t] = W[t] / sqrt(vpath[t])
-
-    if not penalty:
-        objective = -0.5 *( np.log(2*pi) + np.log(vpath) + np.divide(np.multiply(W,W),vpath) )
-        LL = -np.sum(objective)
-
-    return LL, vpath
-
-@njit
-def _numbafiltercngarch(_R, vpath, qpath, W, Z, _la, _p1, _a1, _g1, _p2, _a2, _g2, N):
-    penalty = False
+        LL += 0.5*(np.log(2*pi) + np.log(vpath[t]) + W[t]*W[t]/vpath[t])
+
+        sv = sqrt(vpath[t])
+        for k in range(K):
+            de1 = 2*zp*dZ[k]
+            dvn = _p1*dv[k] + _a1*(dv[k]*e1 + vp*de1)
+            if k==1:
+                dvn += dvar*(1 - _p1)
+            elif k==2:
+                dvn += vp - var
+            elif k==3:
+                dvn += vp*e1
+            grad[k] += dpenv*dvn
+            dvn = dclv*dvn
+            dW = (0.5 - 0.5*_la/sv)*dvn
+            if k==0:
+                dW = dW - sv
+            dv[k] = dvn
+            dZ[k] = dW/sv - 0.5*Z[t]*dvn/vpath[t]
+            grad[k] += 0.5*dvn/vpath[t]*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+
+    return LL + penalty, grad, penalty
+
+
+@njit(cache=True, nogil=True)
+def _numbascorengarch(_R, vpath, W, Z, _la, _sg, _p1, _a1, _g1, N):
+    # natural parameters: [lambda, sigma, persistence, alpha, gamma]
+    K = 5
+    grad = np.zeros((K,), dtype=float)
+    dv = np.zeros((K,), dtype=float)
+    dZ = np.zeros((K,), dtype=float)
+    var = vpath[0]
+    dvar = 2*_sg
+
+    sv = sqrt(vpath[0])
+    dv[1] = dvar
+    for k in range(K):
+        dW = (0.5 - 0.5*_la/sv)*dv[k]
+        if k==0:
+            dW = dW - sv
+        dZ[k] = dW/sv - 0.5*Z[0]*dv[k]/vpath[0]
+        grad[k] += 0.5*dv[k]/vpath[0]*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+
+    LL = 0.5*(np.log(2*pi) + np.log(vpath[0]) + W[0]*W[0]/vpath[0])
+    penalty = 0.0
     for t in range(1,N):
-        qpath[t] = (vpath[0])   + _p2*(qpath[t-1] - vpath[0])   + _a2*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g2*Z[t-1])
-        vpath[t] = (qpath[t])   + _p1*(vpath[t-1] - qpath[t-1]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g1*Z[t-1])
-
-        if (vpath[t]<=1E-6 or qpath[t]<=1E-6 or vpath[t]>1 or qpath[t]>1):
-            LL = 9999.0*(_p1+_a1+_g1+_p2+_a2+_g2)**2
-            penalty = True
-            break
+        vp = vpath[t-1]
+        zp = Z[t-1]
+        e1 = zp*zp - 1 - 2*_g1*zp
+        vraw = (vpath[0]) + _p1*(vpath[t-1] - vpath[0]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g1*Z[t-1])
+        vpath[t], penv, dpenv, dclv = _boundvariance(vraw)
+        penalty += penv
 
         W[t] = (_R[t] - _la*sqrt(vpath[t]) + 0.5*vpath[t])
         Z[t] = W[t] / sqrt(vpath[t])
-
-    if not penalty:
-        objective = -0.5 *( np.log(2*pi) + np.log(vpath) + np.divide(np.multiply(W,W),vpath) )
-        LL = -np.sum(objective)
-
-    return LL, vpath, qpath
-
-
-@njit
-def _numbafiltercgarch(_R, vpath, qpath, W, Z, _la, _p1, _a1, _p2, _a2, N):
-    penalty = False
+        LL += 0.5*(np.log(2*pi) + np.log(vpath[t]) + W[t]*W[t]/vpath[t])
+
+        sv = sqrt(vpath[t])
+        for k in range(K):
+            de1 = (2*zp - 2*_g1)*dZ[k]
+            if k==4:
+                de1 -= 2*zp
+            dvn = _p1*dv[k] + _a1*(dv[k]*e1 + vp*de1)
+            if k==1:
+                dvn += dvar*(1 - _p1)
+            elif k==2:
+                dvn += vp - var
+            elif k==3:
+                dvn += vp*e1
+            grad[k] += dpenv*dvn
+            dvn = dclv*dvn
+            dW = (0.5 - 0.5*_la/sv)*dvn
+            if k==0:
+                dW = dW - sv
+            dv[k] = dvn
+            dZ[k] = dW/sv - 0.5*Z[t]*dvn/vpath[t]
+            grad[k] += 0.5*dvn/vpath[t]*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+
+    return LL + penalty, grad, penalty
+
+
+@njit(cache=True, nogil=True)
+def _numbascorecngarch(_R, vpath, qpath, W, Z, _la, _sg, _p1, _a1, _g1, _p2, _a2, _g2, N):
+    # natural parameters: [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2]
+    K = 8
+    grad = np.zeros((K,), dtype=float)
+    dv = np.zeros((K,), dtype=float)
+    dq = np.zeros((K,), dtype=float)
+    dZ = np.zeros((K,), dtype=float)
+    var = vpath[0]
+    dvar = 2*_sg
+
+    sv = sqrt(vpath[0])
+    dv[1] = dvar
+    dq[1] = dvar
+    for k in range(K):
+        dW = (0.5 - 0.5*_la/sv)*dv[k]
+        if k==0:
+            dW = dW - sv
+        dZ[k] = dW/sv - 0.5*Z[0]*dv[k]/vpath[0]
+        grad[k] += 0.5*dv[k]/vpath[0]*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+
+    LL = 0.5*(np.log(2*pi) + np.log(vpath[0]) + W[0]*W[0]/vpath[0])
+    penalty = 0.0
     for t in range(1,N):
-        qpath[t] = (vpath[0])   + _p2*(qpath[t-1] - vpath[0])   + _a2*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
-        vpath[t] = (qpath[t])   + _p1*(vpath[t-1] - qpath[t-1]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
-
-        if (vpath[t]<=1E-6 or qpath[t]<=1E-6 or vpath[t]>1 or qpath[t]>1):
-            LL = 9999.0*(_p1+_a1+_p2+_a2)**2
-            penalty = True
-            break
+        vp = vpath[t-1]
+        qp = qpath[t-1]
+        zp = Z[t-1]
+        e1 = zp*zp - 1 - 2*_g1*zp
+        e2 = zp*zp - 1 - 2*_g2*zp
+        qraw = (vpath[0])   + _p2*(qpath[t-1] - vpath[0])   + _a2*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g2*Z[t-1])
+        qpath[t], penq, dpenq, dclq = _boundvariance(qraw)
+        vraw = (qpath[t])   + _p1*(vpath[t-1] - qpath[t-1]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1 - 2*_g1*Z[t-1])
+        vpath[t], penv, dpenv, dclv = _boundvariance(vraw)
+        penalty += penq + penv
 
         W[t] = (_R[t] - _la*sqrt(vpath[t]) + 0.5*vpath[t])
         Z[t] = W[t] / sqrt(vpath[t])
+        LL += 0.5*(np.log(2*pi) + np.log(vpath[t]) + W[t]*W[t]/vpath[t])
+
+        sv = sqrt(vpath[t])
+        for k in range(K):
+            de1 = (2*zp - 2*_g1)*dZ[k]
+            de2 = (2*zp - 2*_g2)*dZ[k]
+            if k==4:
+                de1 -= 2*zp
+            elif k==7:
+                de2 -= 2*zp
+            dqn = _p2*dq[k] + _a2*(dv[k]*e2 + vp*de2)
+            if k==1:
+                dqn += dvar*(1 - _p2)
+            elif k==5:
+                dqn += qp - var
+            elif k==6:
+                dqn += vp*e2
+            grad[k] += dpenq*dqn
+            dqn = dclq*dqn
+            dvn = dqn + _p1*(dv[k] - dq[k]) + _a1*(dv[k]*e1 + vp*de1)
+            if k==2:
+                dvn += vp - qp
+            elif k==3:
+                dvn += vp*e1
+            grad[k] += dpenv*dvn
+            dvn = dclv*dvn
+            dW = (0.5 - 0.5*_la/sv)*dvn
+            if k==0:
+                dW = dW - sv
+            dq[k] = dqn
+            dv[k] = dvn
+            dZ[k] = dW/sv - 0.5*Z[t]*dvn/vpath[t]
+            grad[k] += 0.5*dvn/vpath[t]*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+
+    return LL + penalty, grad, penalty
+
+
+@njit(cache=True, nogil=True)
+def _numbascorecgarch(_R, vpath, qpath, W, Z, _la, _sg, _p1, _a1, _p2, _a2, N):
+    # natural parameters: [lambda, sigma, pers. ST, alpha_ST, pers. LT, alpha_LT]
+    K = 6
+    grad = np.zeros((K,), dtype=float)
+    dv = np.zeros((K,), dtype=float)
+    dq = np.zeros((K,), dtype=float)
+    dZ = np.zeros((K,), dtype=float)
+    var = vpath[0]
+    dvar = 2*_sg
+
+    sv = sqrt(vpath[0])
+    dv[1] = dvar
+    dq[1] = dvar
+    for k in range(K):
+        dW = (0.5 - 0.5*_la/sv)*dv[k]
+        if k==0:
+            dW = dW - sv
+        dZ[k] = dW/sv - 0.5*Z[0]*dv[k]/vpath[0]
+        grad[k] += 0.5*dv[k]/vpath[0]*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+
+    LL = 0.5*(np.log(2*pi) + np.log(vpath[0]) + W[0]*W[0]/vpath[0])
+    penalty = 0.0
+    for t in range(1,N):
+        vp = vpath[t-1]
+        qp = qpath[t-1]
+        zp = Z[t-1]
+        e1 = zp*zp - 1
+        qraw = (vpath[0])   + _p2*(qpath[t-1] - vpath[0])   + _a2*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
+        qpath[t], penq, dpenq, dclq = _boundvariance(qraw)
+        vraw = (qpath[t])   + _p1*(vpath[t-1] - qpath[t-1]) + _a1*vpath[t-1]*(Z[t-1]*Z[t-1] - 1)
+        vpath[t], penv, dpenv, dclv = _boundvariance(vraw)
+        penalty += penq + penv
 
-    if not penalty:
-        objective = -0.5 *( np.log(2*pi) + np.log(vpath) + np.divide(np.multiply(W,W),vpath) )
-        LL = -np.sum(objective)
-
-    return LL, vpath, qpath
-
+        W[t] = (_R[t] - _la*sqrt(vpath[t]) + 0.5*vpath[t])
+        Z[t] = W[t] / sqrt(vpath[t])
+        LL += 0.5*(np.log(2*pi) + np.log(vpath[t]) + W[t]*W[t]/vpath[t])
+
+        sv = sqrt(vpath[t])
+        for k in range(K):
+            de1 = 2*zp*dZ[k]
+            dqn = _p2*dq[k] + _a2*(dv[k]*e1 + vp*de1)
+            if k==1:
+                dqn += dvar*(1 - _p2)
+            elif k==4:
+                dqn += qp - var
+            elif k==5:
+                dqn += vp*e1
+            grad[k] += dpenq*dqn
+            dqn = dclq*dqn
+            dvn = dqn + _p1*(dv[k] - dq[k]) + _a1*(dv[k]*e1 + vp*de1)
+            if k==2:
+                dvn += vp - qp
+            elif k==3:
+                dvn += vp*e1
+            grad[k] += dpenv*dvn
+            dvn = dclv*dvn
+            dW = (0.5 - 0.5*_la/sv)*dvn
+            if k==0:
+                dW = dW - sv
+            dq[k] = dqn
+            dv[k] = dvn
+            dZ[k] = dW/sv - 0.5*Z[t]*dvn/vpath[t]
+            grad[k] += 0.5*dvn/vpath[t]*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+
+    return LL + penalty, grad, penalty
+
+
+
+@njit(cache=True, nogil=True)
+def _numbascore(_R, paths, W, Z, natural, N, scores):
+    # The score kernel of _numbafilter for any number of components K, the derivatives of every component w.r.t.
+    # the 2 + 3*K natural parameters are carried in dc (day t-1) and dcn (day t).
+    # scores shaped (N, 2 + 3*K) receives the contribution of every day to the gradient, shaped (0, 2 + 3*K) it is
+    # left out
+    K = paths.shape[0]
+    P = 2 + 3*K
+    _la = natural[0]
+    grad = np.zeros((P,), dtype=float)
+    dc = np.zeros((K,P), dtype=float)
+    dcn = np.zeros((K,P), dtype=float)
+    dZ = np.zeros((P,), dtype=float)
+    var = paths[0,0]
+    dvar = 2*natural[1]
+    keep = scores.shape[0]>0
+
+    sv = sqrt(var)
+    dc[:,1] = dvar
+    for j in range(P):
+        dW = (0.5 - 0.5*_la/sv)*dc[0,j]
+        if j==0:
+            dW = dW - sv
+        dZ[j] = dW/sv - 0.5*Z[0]*dc[0,j]/var
+        grad[j] += 0.5*dc[0,j]/var*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+        if keep:
+            scores[0,j] = 0.5*dc[0,j]/var*(1 - Z[0]*Z[0]) + Z[0]*dW/sv
+
+    LL = 0.5*(np.log(2*pi) + np.log(var) + W[0]*W[0]/var)
+    penalty = 0.0
+    for t in range(1,N):
+        vp = paths[0,t-1]
+        zp = Z[t-1]
+        nxt = var
+        older = var
+        day = 0.0
+        for k in range(K-1, -1, -1):
+            pk = natural[2+3*k]
+            ak = natural[3+3*k]
+            gk = natural[4+3*k]
+            e = zp*zp - 1 - 2*gk*zp
+            cp = paths[k,t-1]
+            paths[k,t], pen, dpen, dcl = _boundvariance((nxt) + pk*(cp - older) + ak*vp*e)
+            day += pen
+            for j in range(P):
+                de = (2*zp - 2*gk)*dZ[j]
+                if j==4+3*k:
+                    de -= 2*zp
+                if k==K-1:
+                    dnxt = 0.0
+                    dolder = 0.0
+                    if j==1:
+                        dnxt = dvar
+                        dolder = dvar
+                else:
+                    dnxt = dcn[k+1,j]
+                    dolder = dc[k+1,j]
+                draw = dnxt + pk*(dc[k,j] - dolder) + ak*(dc[0,j]*e + vp*de)
+                if j==2+3*k:
+                    draw += cp - older
+                elif j==3+3*k:
+                    draw += vp*e
+                grad[j] += dpen*draw
+                if keep:
+                    scores[t,j] += dpen*draw
+                dcn[k,j] = dcl*draw
+            nxt = paths[k,t]
+            older = cp
+        penalty += day
+
+        v = paths[0,t]
+        W[t] = (_R[t] - _la*sqrt(v) + 0.5*v)
+        Z[t] = W[t] / sqrt(v)
+        LL += 0.5*(np.log(2*pi) + np.log(v) + W[t]*W[t]/v)
+
+        sv = sqrt(v)
+        for j in range(P):
+            dW = (0.5 - 0.5*_la/sv)*dcn[0,j]
+            if j==0:
+                dW = dW - sv
+            dZ[j] = dW/sv - 0.5*Z[t]*dcn[0,j]/v
+            grad[j] += 0.5*dcn[0,j]/v*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+            if keep:
+                scores[t,j] += 0.5*dcn[0,j]/v*(1 - Z[t]*Z[t]) + Z[t]*dW/sv
+        dc, dcn = dcn, dc
+
+    return LL + penalty, grad, penalty
+
+
+@njit(cache=True, nogil=True)
+def _numbaloglikelihood(_R, natural, N):
+    # Negative log-likelihood of the recursion for the natural parameters, see _numbafilter.
+    # Nothing but the running state is stored, the likelihood is accumulated along the recursion.
+    # Returns (negative log-likelihood with the penalty of the variance bounds, that penalty)
+    K = (len(natural) - 2)//3
+    _la = natural[0]
+    var = natural[1]*natural[1]
+    c = np.full((K,), var)
+    v = var
+    W = _R[0] - _la*sqrt(v) + 0.5*v
+    Z = W / sqrt(v)
+    LL = 0.5*(np.log(2*pi) + np.log(v) + W*W/v)
+    penalty = 0.0
+    for t in range(1,N):
+        penalty += _numbastep(natural, c, Z, var)
+        v = c[0]
+        W = (_R[t] - _la*sqrt(v) + 0.5*v)
+        Z = W / sqrt(v)
+        LL += 0.5*(np.log(2*pi) + np.log(v) + W*W/v)
+
+    return LL + penalty, penalty
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def _numbabatchll(_R, natural, N):
+    # _numbaloglikelihood for every row of natural parameters. Rows with a starting variance below 1E-6 get np.inf.
+    nbest = natural.shape[0]
+    LLs = np.zeros((nbest,), dtype=float)
+    for iest in prange(nbest):
+        if natural[iest,1]*natural[iest,1]<1E-6:
+            LLs[iest] = np.inf
+            continue
+        LLs[iest] = _numbaloglikelihood(_R, natural[iest,:], N)[0]
+
+    return LLs
+
+
+@njit(cache=True, nogil=True)
+def _numbaupdate(_R, paths, natural, z, start, stop):
+    # Continue the recursion over the days [start, stop) of paths (one row per component) from the state of
+    # day start-1 and its innovation z. Returns the negative log-likelihood of the new days and the last innovation.
+    _la = natural[0]
+    var = natural[1]*natural[1]
+    c = paths[:,start-1].copy()
+    LL = 0.0
+    penalty = 0.0
+    for t in range(start, stop):
+        penalty += _numbastep(natural, c, z, var)
+        paths[:,t] = c
+        v = c[0]
+        W = (_R[t] - _la*sqrt(v) + 0.5*v)
+        z = W / sqrt(v)
+        LL += 0.5*(np.log(2*pi) + np.log(v) + W*W/v)
+
+    return LL + penalty, z
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def _numbasimulate(natural, c0, z0, R, paths):
+    # Simulate the recursion from the state c0 (one value per component) and innovation z0 of the last filtered day.
+    # R holds standard normal draws on entry and the simulated returns on exit, paths[k,ipath,t] is component k+1.
+    _la = natural[0]
+    var = natural[1]*natural[1]
+    npaths, horizon = R.shape
+    for ipath in prange(npaths):
+        c = c0.copy()
+        z = z0
+        for t in range(horizon):
+            _numbastep(natural, c, z, var)
+            v = c[0]
+            z = R[ipath,t]
+            R[ipath,t] = _la*sqrt(v) - 0.5*v + sqrt(v)*z
+            paths[:,ipath,t] = c
+
+
+@njit(cache=True, nogil=True)
+def _numbaforecast(natural, c0, hmax):
+    # Expected components 0..hmax days after the states c0 (one row per starting day), with the forecast recursion
+    # c_K,h = sigma^2 + pers_K*(c_K,h-1 - sigma^2), c_k,h = c_k+1,h + pers_k*(c_k,h-1 - c_k+1,h).
+    # Returns forecasts[istart, k, h]
+    nstarts, K = c0.shape
+    var = natural[1]*natural[1]
+    forecasts = np.zeros((nstarts, K, hmax+1), dtype=float)
+    for istart in range(nstarts):
+        forecasts[istart,:,0] = c0[istart,:]
+        for h in range(1, hmax+1):
+            nxt = var
+            for k in range(K-1, -1, -1):
+                forecasts[istart,k,h] = nxt + natural[2+3*k]*(forecasts[istart,k,h-1] - nxt)
+                nxt = forecasts[istart,k,h]
+    return forecasts
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def _numbabank(R, la, sg, persistence, alpha, gamma, paths, forecasts):
+    # The recursion of _numbafilter then the forecasts of _numbaforecast for every asset (row of R), one asset per
+    # thread. The parameters are a struct of arrays: la and sg shaped (assets,), persistence, alpha, gamma (assets, K).
+    # Fills paths[k,asset,t] and forecasts[k,asset,h] (h = 0..hmax), returns the negative log-likelihoods
+    nassets, N = R.shape
+    K = persistence.shape[1]
+    hmax = forecasts.shape[2] - 1
+    LLs = np.zeros((nassets,), dtype=float)
+    for iasset in prange(nassets):
+        _la = la[iasset]
+        var = sg[iasset]*sg[iasset]
+        for k in range(K):
+            paths[k,iasset,0] = var
+        v = var
+        W = R[iasset,0] - _la*sqrt(v) + 0.5*v
+        z = W / sqrt(v)
+        LL = 0.5*(np.log(2*pi) + np.log(v) + W*W/v)
+        penalty = 0.0
+        for t in range(1,N):
+            nxt = var
+            older = var
+            for k in range(K-1, -1, -1):
+                cp = paths[k,iasset,t-1]
+                raw = (nxt) + persistence[iasset,k]*(cp - older) + alpha[iasset,k]*v*(z*z - 1 - 2*gamma[iasset,k]*z)
+                paths[k,iasset,t], pen, dpen, dcl = _boundvariance(raw)
+                penalty += pen
+                nxt = paths[k,iasset,t]
+                older = cp
+            v = paths[0,iasset,t]
+            W = (R[iasset,t] - _la*sqrt(v) + 0.5*v)
+            z = W / sqrt(v)
+            LL += 0.5*(np.log(2*pi) + np.log(v) + W*W/v)
+        LLs[iasset] = LL + penalty
+
+        for k in range(K):
+            forecasts[k,iasset,0] = paths[k,iasset,N-1]
+        for h in range(1, hmax+1):
+            nxt = var
+            for k in range(K-1, -1, -1):
+                forecasts[k,iasset,h] = nxt + persistence[iasset,k]*(forecasts[k,iasset,h-1] - nxt)
+                nxt = forecasts[k,iasset,h]
+    return LLs
 
 
 class garch(gmodel):
     """
         GARCH model
         x=[lambda, sigma (per period), persistence, alpha]
+        without sigma when targetV (the sample standard deviation of R) and without alpha when targetK (alpha gives
+        the model the kurtosis targetK, the sample kurtosis of R when True)
     """ 
-    def __init__(self, x:list[float], R=np.zeros((1, )), targetK=False) -> None:
+    _gradientindex = (0, 1, 2, 3)
+
+    def __init__(self, x:list[float], R=np.zeros((1, )), targetK=False, targetV=False) -> None:
         """
             x = [lambda, sigma, persistense, alpha]
         """
         super().__init__(x, R=R)
         self._targetK = targetK
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        if not self._targetK:
-            self._a1 = x[3]
-            # self._g1 = x[4]
-        else:
-            print('This is not implemented for this specification')
-            self._a1 = x[3]
-            # self._g1 = x[4]
-
+        self._targetV = targetV
+        self.set_theta(x)
 
     def name(self)->str:
         return 'garch'
 
+    def _specification(self)->dict:
+        return {'targetK':self._targetK, 'targetV':self._targetV}
+
     def __str__(self) -> str:
-        smodel = "GARCH(1,1)"
-        if not self._targetK:
-            smodel = smodel + "\n"
-        else:
-            smodel = smodel + f" with kurtosis targetting at {self._targetK}\n"
+        smodel = "GARCH(1,1)" + self._targetdescription() + "\n"
         sparam = f"[lambda, sigma, persistense,  alpha] = [{self._la}, {self._sg}, {self._p1}, {self._a1}]\n"
         return super().__str__() + smodel + sparam
 
     @property
     def glabel(self):
-        if not self._targetK:
-            return 'GARCH(1,1)'
-        else:
-            return f"NGARCH-KTE-{self._targetK}"
+        return 'GARCH(1,1)' + self._targetlabel()
 
     @property
     def uncvol(self):
         return self._sg
 
     def set_theta(self, x):
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        if not self._targetK:
-            self._a1 = x[3]
-            # self._g1 = x[4]
-        else:
-            print('This is not implemented for this specification')
-            self._a1 = x[3]
-            # self._g1 = x[4]
+        full = self._targeted(x)
+        self._la = full[0]
+        self._sg = full[1]
+        self._p1 = full[2]
+        self._a1 = full[3]
+        if self._targetK:
+            self._a1 = self._targetalpha()
         return super().set_theta(x)
 
 
@@ -356,6 +1325,11 @@ class garch(gmodel):
         return self._p1 - self._a1  + self._a1 * (1 + ( self._la)*( self._la))
 
 
+    def _natural(self):
+        # [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2] with a constant LT component
+        return np.array([self._la, self._sg, self._p1, self._a1, 0.0, 1.0, 0.0, 0.0])
+
+
     def _penalty_constraints(self):
         # unc.vol. positive
         penalty = self._pen(-self._sg)
@@ -370,45 +1344,46 @@ class garch(gmodel):
         return penalty
 
 
-    def forecast(self, kdays:int)->np.ndarray:
-        if not self.vpath[-1]>0:
-            self.filter()
-        
-        self.vforecast = np.ones((kdays+1,),dtype=float)*self.vpath[-1]
-        variance = self._sg*self._sg
-        for ik in range(1,kdays+1):
-            self.vforecast[ik] = variance + self._p1*(self.vforecast[ik-1] - variance) 
+    def _penalty_gradient(self):
+        # gradient of _penalty_constraints w.r.t. [lambda, sigma, persistence, alpha], persistenceQ = p1 + a1*lambda^2
+        grad = np.zeros((4,), dtype=float)
+        grad[1] = -self._dpen(-self._sg) + self._dpen(self._sg-1)
+        dQ = self._dpen(self.persistenceQ-1)
+        grad[0] = dQ*2*self._a1*self._la
+        grad[2] = dQ
+        grad[3] = dQ*self._la*self._la - self._dpen(-self._a1)
+        return grad
 
 
+    def _score(self, vpath, qpath, W, Z, N):
+        return _numbascoregarch(self._R, vpath, W, Z, self._la, self._sg, self._p1, self._a1, N)
+
     def filter(self, output="variance", debug=False):
         penalty = self._penalty_constraints()
         # if debug:
         #     print(f"Penalty = {penalty}")
-        if penalty>0:
-            if output=='estimate':
-                return penalty
-            # else:
-            #     warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
-        
+        # if penalty>0:
+            # warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
+        if output in ['estimate', 'gradient']:
+            return self._objective(output, penalty)
+
         N = len(self._R)
         vpath, Z = np.ones((N,), dtype=float), np.ones((N,), dtype=float)
         # W, Z     = np.zeros((N,), dtype=float), np.zeros((N,), dtype=float)
         W     = np.ones((N,), dtype=float)
 
         vpath[0] = self._sg*self._sg
-        if vpath[0]<1E-6:
-            if output=='estimate':
-                return 9999*LA.norm(self.x)
-            # else:
-                # warnings.warn('The filtering found a negative variance. Filtering might be bad')
+        # if vpath[0]<1E-6:
+            # warnings.warn('The filtering found a negative variance. Filtering might be bad')
 
         W[0] = self._R[0] - self._la*sqrt(vpath[0]) + 0.5*vpath[0]
         Z[0] = W[0] / sqrt(vpath[0]) 
 
-        LL, vpath = _numbafiltergarch(self._R, vpath, W, Z, self._la, self._p1, self._a1, N)
+        LL = _numbafilter(self._R, vpath.reshape((1,N)), W, Z, self._kernelnatural(), N)
 
         self.vpath = vpath
         self.loglikelihood = LL
+        self._zlast = Z[-1]
         return LL
 
 
@@ -417,32 +1392,31 @@ class cgarch(gmodel):
         Component-GARCH model
         x=[lambda, sigma (per period), ST_persistence, alpha_ST, LT_persistence, alpha_LT]
     """
-    def __init__(self, x:list[float], R=np.zeros((1, )), Qpers=False) -> None:
+    _components = 2
+    _gradientindex = (0, 1, 2, 3, 5, 6)
+
+    def __init__(self, x:list[float], R=np.zeros((1, )), Qpers=False, targetK=False, targetV=False) -> None:
         """
             x='[lambda, sigma, ST_persistence, alpha_ST, LT_persistence, alpha_LT]'
+            without sigma when targetV and without alpha_ST when targetK, see garch
         """
         super().__init__(x, R=R)
         self._Qpers = Qpers
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        self._a1 = x[3]
-        if not self._Qpers:
-            self._p2 = x[4]
-            self._a2 = x[5]
-        else:
-            self._a2 = x[4]
-            self._p2 = 1 - self._a2 * (1 + (self._la*self._la)) + self._a2
+        self._targetK = targetK
+        self._targetV = targetV
+        self.set_theta(x)
 
     def name(self)->str:
         return 'cgarch'
 
+    def _specification(self)->dict:
+        return {'Qpers':self._Qpers, 'targetK':self._targetK, 'targetV':self._targetV}
+
     def __str__(self) -> str:
         smodel = "Component GARCH(1,1)"
-        if not self._Qpers:
-            smodel = smodel + "\n"
-        else:
-            smodel = smodel + f" with full Qpers\n"
+        if self._Qpers:
+            smodel = smodel + f" with full Qpers"
+        smodel = smodel + self._targetdescription() + "\n"
         sparam = f"[lambda, sigma, ST_persistence, ST_alpha, LT_persistence LT_alpha] = ["\
             f"{self._la}, {self._sg}, {self._p1}, {self._a1}, "\
                 f"{self._p2}, {self._a2}]\n"
@@ -458,21 +1432,24 @@ class cgarch(gmodel):
     @property
     def glabel(self):
         if not self._Qpers:
-            return 'C-GARCH(1,1)'
+            return 'C-GARCH(1,1)' + self._targetlabel()
         else:
-            return f"CGARCH(1,1) with full Q persistence"
+            return f"CGARCH(1,1) with full Q persistence" + self._targetlabel()
 
     def set_theta(self, x):
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        self._a1 = x[3]
+        full = self._targeted(x)
+        self._la = full[0]
+        self._sg = full[1]
+        self._p1 = full[2]
+        self._a1 = full[3]
         if not self._Qpers:
-            self._p2 = x[4]
-            self._a2 = x[5]
+            self._p2 = full[4]
+            self._a2 = full[5]
         else:
-            self._a2 = x[4]
+            self._a2 = full[4]
             self._p2 = 1 - self._a2 * (1 + (self._la*self._la)) + self._a2
+        if self._targetK:
+            self._a1 = self._targetalpha()
         return super().set_theta(x)
 
 
@@ -486,6 +1463,11 @@ class cgarch(gmodel):
         return self._p2 - self._a2 + self._a2 * (1 + (self._la*self._la))
 
 
+    def _natural(self):
+        # [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2] without asymmetry
+        return np.array([self._la, self._sg, self._p1, self._a1, 0.0, self._p2, self._a2, 0.0])
+
+
     def _penalty_constraints(self):
         # unc.vol. positive
         penalty = self._pen(-self._sg+1E-10)
@@ -504,121 +1486,118 @@ class cgarch(gmodel):
         return penalty
 
 
-    def forecast(self, kdays:int)->np.ndarray:
-        if not self.vpath[-1]>0:
-            self.filter()
-        
-        self.vforecast = np.ones((kdays+1,),dtype=float)*self.vpath[-1]
-        self.qforecast = np.ones((kdays+1,),dtype=float)*self.qpath[-1]
-        
-        var = self._sg*self._sg
+    def _penalty_gradient(self):
+        # gradient of _penalty_constraints w.r.t. [lambda, sigma, ST_persistence, alpha_ST, LT_persistence, alpha_LT]
+        # persistenceQ = p2 + a2*lambda^2, mapped to x by _chaingradient
+        grad = np.zeros((6,), dtype=float)
+        grad[1] = -self._dpen(-self._sg+1E-10) + self._dpen(self._sg-1)
+        dQ = self._dpen(self.persistenceQ-1)
+        grad[0] = dQ*2*self._a2*self._la
+        grad[2] = -self._dpen(-self._p1)
+        grad[3] = -self._dpen(-self._a1) + self._dpen(self._a1-1)
+        grad[4] = dQ - self._dpen(-self._p2) + self._dpen(self._p2-1)
+        grad[5] = dQ*self._la*self._la - self._dpen(-self._a2) + self._dpen(self._a2-1)
+        return grad
 
-        for t in range(1,kdays+1):
-            self.qforecast[t] = var                + self._p2*(self.qforecast[t-1] - var)         
-            self.vforecast[t] = self.qforecast[t]  + self._p1*(self.vforecast[t-1] - self.qforecast[t])   
-            if (self.vforecast[t]<1E-6):
-                self.vforecast[t]=1E-6
-            if (self.qforecast[t]<1E-6):
-                self.qforecast[t]=1E-6
 
+    def _chaingradient(self, grad):
+        # gradient w.r.t. [lambda, sigma, ST_persistence, alpha_ST, LT_persistence, alpha_LT] mapped to x
+        if not self._Qpers:
+            return grad
+        # p2 = 1 - alpha_LT*lambda^2
+        gx = np.delete(grad, 4)
+        gx[0] += grad[4]*(-2*self._a2*self._la)
+        gx[4] += grad[4]*(-self._la*self._la)
+        return gx
+
+
+    def _score(self, vpath, qpath, W, Z, N):
+        return _numbascorecgarch(self._R, vpath, qpath, W, Z, self._la, self._sg, self._p1, self._a1, self._p2, self._a2, N)
 
     def filter(self, output="variance", debug=False):
-        np.seterr(all='raise')
-        N = len(self._R)
         penalty = self._penalty_constraints()
         if debug:
             print(f"Penalty = {penalty}")
+        if output in ['estimate', 'gradient']:
+            return self._objective(output, penalty)
+
+        np.seterr(all='raise')
+        N = len(self._R)
         if penalty>0:
-            if output=='estimate':
-                return penalty
-            else:
-                warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
-                # vpath = np.zeros((N,), dtype=float)
-                # qpath = np.zeros((N,), dtype=float)
-                self.qpath = np.zeros((N,), dtype=float)
-                self.vpath = np.zeros((N,), dtype=float)
-                self.success = False
-                return
+            warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
+            # vpath = np.zeros((N,), dtype=float)
+            # qpath = np.zeros((N,), dtype=float)
+            self.qpath = np.zeros((N,), dtype=float)
+            self.vpath = np.zeros((N,), dtype=float)
+            self.success = False
+            return
         
-        vpath = np.zeros((N,), dtype=float)
-        qpath = np.zeros((N,), dtype=float)
+        paths = np.zeros((2,N), dtype=float)
+        vpath, qpath = paths[0], paths[1]
         W     = np.zeros((N,), dtype=float)
         Z     = np.zeros((N,), dtype=float)
 
         vpath[0] = self._sg*self._sg
         if vpath[0]<1E-6:
-            if output=='estimate':
-                return 9999*LA.norm(self.x)
-            else:
-                warnings.warn('The filtering found a negative variance. Filtering might be bad')
-                self.qpath = np.zeros((N,), dtype=float)
-                self.vpath = np.zeros((N,), dtype=float)
-                self.success = False
-                return
+            warnings.warn('The filtering found a negative variance. Filtering might be bad')
+            self.qpath = np.zeros((N,), dtype=float)
+            self.vpath = np.zeros((N,), dtype=float)
+            self.success = False
+            return
         qpath[0] = vpath[0]
 
 
         W[0] = self._R[0] - self._la*sqrt(vpath[0]) + 0.5*vpath[0]
         Z[0] = W[0] / sqrt(vpath[0]) 
 
-        LL, vpath, qpath = _numbafiltercgarch(self._R, vpath, qpath, W, Z, self._la, self._p1, self._a1, self._p2, self._a2, N)
+        LL = _numbafilter(self._R, paths, W, Z, self._kernelnatural(), N)
         
         self.qpath = qpath
         self.vpath = vpath
         self.loglikelihood = LL
+        self._zlast = Z[-1]
         return LL
 
 
 
 class ngarch(gmodel):
     # 
-    def __init__(self, x=list[float], R=np.zeros((1, )), targetK=False) -> None:
+    _gradientindex = (0, 1, 2, 3, 4)
+
+    def __init__(self, x=list[float], R=np.zeros((1, )), targetK=False, targetV=False) -> None:
         """
             x='[lambda, sigma, persistense, alpha, gamma]'
+            without sigma when targetV and without alpha when targetK, see garch
         """
         super().__init__(x, R=R)
         self._targetK = targetK
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        if not self._targetK:
-            self._a1 = x[3]
-            self._g1 = x[4]
-        else:
-            print('This is not implemented for this specification')
-            self._a1 = x[3]
-            self._g1 = x[4]
+        self._targetV = targetV
+        self.set_theta(x)
 
     def name(self)->str:
         return 'ngarch'
 
+    def _specification(self)->dict:
+        return {'targetK':self._targetK, 'targetV':self._targetV}
+
     def __str__(self) -> str:
-        smodel = "NGARCH(1,1)"
-        if not self._targetK:
-            smodel = smodel + "\n"
-        else:
-            smodel = smodel + f" with kurtosis targetting at {self._targetK}\n"
+        smodel = "NGARCH(1,1)" + self._targetdescription() + "\n"
         sparam = f"[lambda, sigma, persistense,  alpha,  gamma] = [{self._la}, {self._sg}, {self._p1}, {self._a1}, {self._g1}]\n"
         return super().__str__() + smodel + sparam
 
     @property
     def glabel(self):
-        if not self._targetK:
-            return 'NGARCH(1,1)'
-        else:
-            return f"NGARCH-KTE-{self._targetK}"
+        return 'NGARCH(1,1)' + self._targetlabel()
 
     def set_theta(self, x):
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        if not self._targetK:
-            self._a1 = x[3]
-            self._g1 = x[4]
-        else:
-            print('This is not implemented for this specification')
-            self._a1 = x[3]
-            self._g1 = x[4]
+        full = self._targeted(x)
+        self._la = full[0]
+        self._sg = full[1]
+        self._p1 = full[2]
+        self._a1 = full[3]
+        self._g1 = full[4]
+        if self._targetK:
+            self._a1 = self._targetalpha()
         return super().set_theta(x)
 
 
@@ -632,6 +1611,11 @@ class ngarch(gmodel):
         return self._p1 - self._a1 * (1 + self._g1*self._g1) + self._a1 * (1 + (self._g1 + self._la)*(self._g1 + self._la))
 
 
+    def _natural(self):
+        # [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2] with a constant LT component
+        return np.array([self._la, self._sg, self._p1, self._a1, self._g1, 1.0, 0.0, 0.0])
+
+
     def _penalty_constraints(self):
         # unc.vol. positive
         penalty = self._pen(-self._sg)
@@ -644,78 +1628,77 @@ class ngarch(gmodel):
         return penalty
 
 
-    def forecast(self, kdays:int)->np.ndarray:
-        if not self.vpath[-1]>0:
-            self.filter()
-        
-        self.vforecast = np.ones((kdays+1,),dtype=float)*self.vpath[-1]
-        variance = self._sg*self._sg
-        for ik in range(1,kdays+1):
-            self.vforecast[ik] = variance + self._p1*(self.vforecast[ik-1] - variance) 
+    def _penalty_gradient(self):
+        # gradient of _penalty_constraints w.r.t. [lambda, sigma, persistence, alpha, gamma]
+        # persistenceQ = p1 + a1*(lambda^2 + 2*gamma*lambda)
+        grad = np.zeros((5,), dtype=float)
+        grad[1] = -self._dpen(-self._sg) + self._dpen(self._sg-1)
+        dQ = self._dpen(self.persistenceQ-1)
+        grad[0] = dQ*2*self._a1*(self._la + self._g1)
+        grad[2] = dQ
+        grad[3] = dQ*(self._la*self._la + 2*self._g1*self._la) - self._dpen(-self._a1)
+        grad[4] = dQ*2*self._a1*self._la
+        return grad
+
+
+    def _score(self, vpath, qpath, W, Z, N):
+        return _numbascorengarch(self._R, vpath, W, Z, self._la, self._sg, self._p1, self._a1, self._g1, N)
 
     def filter(self, output="variance", debug=False):
         penalty = self._penalty_constraints()
         # if debug:
         #     print(f"Penalty = {penalty}")
-        if penalty>0:
-            if output=='estimate':
-                return penalty
-            # else:
-            #     warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
-        
+        # if penalty>0:
+            # warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
+        if output in ['estimate', 'gradient']:
+            return self._objective(output, penalty)
+
         N = len(self._R)
         vpath, Z = np.ones((N,), dtype=float), np.ones((N,), dtype=float)
         # W, Z     = np.zeros((N,), dtype=float), np.zeros((N,), dtype=float)
         W     = np.ones((N,), dtype=float)
 
         vpath[0] = self._sg*self._sg
-        if vpath[0]<1E-6:
-            if output=='estimate':
-                return 9999*LA.norm(self.x)
-            # else:
-                # warnings.warn('The filtering found a negative variance. Filtering might be bad')
+        # if vpath[0]<1E-6:
+            # warnings.warn('The filtering found a negative variance. Filtering might be bad')
 
         W[0] = self._R[0] - self._la*sqrt(vpath[0]) + 0.5*vpath[0]
         Z[0] = W[0] / sqrt(vpath[0]) 
 
-        LL, vpath = _numbafilterngarch(self._R, vpath, W, Z, self._la, self._p1, self._a1, self._g1, N)
+        LL = _numbafilter(self._R, vpath.reshape((1,N)), W, Z, self._kernelnatural(), N)
 
         self.vpath = vpath
         self.loglikelihood = LL
+        self._zlast = Z[-1]
         return LL
 
 
 class cngarch(gmodel):
     # 
-    def __init__(self, x:list[float], R=np.zeros((1, )), Qpers=False) -> None:
+    _components = 2
+
+    def __init__(self, x:list[float], R=np.zeros((1, )), Qpers=False, targetK=False, targetV=False) -> None:
         """
             x='[lambda, sigma, persistense, alpha, gamma, rho, alph2, gamm2]'
+            without sigma when targetV and without alpha when targetK, see garch
         """
         super().__init__(x, R=R)
         self._Qpers = Qpers
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        self._a1 = x[3]
-        self._g1 = x[4]
-        if not self._Qpers:
-            self._p2 = x[5]
-            self._a2 = x[6]
-            self._g2 = x[7]
-        else:
-            self._a2 = x[5]
-            self._g2 = x[6]
-            self._p2 = 1 - self._a2 * (1 + (self._g2 + self._la)*(self._g2 + self._la)) + self._a2 * (1 + self._g2*self._g2)
+        self._targetK = targetK
+        self._targetV = targetV
+        self.set_theta(x)
 
     def name(self)->str:
         return 'cngarch'
 
+    def _specification(self)->dict:
+        return {'Qpers':self._Qpers, 'targetK':self._targetK, 'targetV':self._targetV}
+
     def __str__(self) -> str:
         smodel = "Component NGARCH(1,1)"
-        if not self._Qpers:
-            smodel = smodel + "\n"
-        else:
-            smodel = smodel + f" with full Qpers\n"
+        if self._Qpers:
+            smodel = smodel + f" with full Qpers"
+        smodel = smodel + self._targetdescription() + "\n"
         sparam = f"[lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2] = ["\
             f"{self._la}, {self._sg}, {self._p1}, {self._a1}, {self._g1}, "\
                 f"{self._p2}, {self._a2}, {self._g2}]\n"
@@ -724,24 +1707,27 @@ class cngarch(gmodel):
     @property
     def glabel(self):
         if not self._Qpers:
-            return 'C-NGARCH(1,1)'
+            return 'C-NGARCH(1,1)' + self._targetlabel()
         else:
-            return f"CNGARCH(1,1) with full Q persistence"
+            return f"CNGARCH(1,1) with full Q persistence" + self._targetlabel()
 
     def set_theta(self, x):
-        self._la = x[0]
-        self._sg = x[1]
-        self._p1 = x[2]
-        self._a1 = x[3]
-        self._g1 = x[4]
+        full = self._targeted(x)
+        self._la = full[0]
+        self._sg = full[1]
+        self._p1 = full[2]
+        self._a1 = full[3]
+        self._g1 = full[4]
         if not self._Qpers:
-            self._p2 = x[5]
-            self._a2 = x[6]
-            self._g2 = x[7]
+            self._p2 = full[5]
+            self._a2 = full[6]
+            self._g2 = full[7]
         else:
-            self._a2 = x[5]
-            self._g2 = x[6]
+            self._a2 = full[5]
+            self._g2 = full[6]
             self._p2 = 1 - self._a2 * (1 + (self._g2 + self._la)*(self._g2 + self._la)) + self._a2 * (1 + self._g2*self._g2)
+        if self._targetK:
+            self._a1 = self._targetalpha()
         return super().set_theta(x)
 
 
@@ -755,6 +1741,11 @@ class cngarch(gmodel):
         return self._p2 - self._a2 * (1 + self._g2*self._g2) + self._a2 * (1 + (self._g2 + self._la)*(self._g2 + self._la))
 
 
+    def _natural(self):
+        # [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2]
+        return np.array([self._la, self._sg, self._p1, self._a1, self._g1, self._p2, self._a2, self._g2])
+
+
     def _penalty_constraints(self):
         # unc.vol. positive
         penalty = self._pen(-self._sg+1E-10)
@@ -773,70 +1764,255 @@ class cngarch(gmodel):
         return penalty
 
 
-    def forecast(self, kdays:int)->np.ndarray:
-        if not self.vpath[-1]>0:
-            self.filter()
-        
-        self.vforecast = np.ones((kdays+1,),dtype=float)*self.vpath[-1]
-        self.qforecast = np.ones((kdays+1,),dtype=float)*self.qpath[-1]
-        
-        var = self._sg*self._sg
+    def _penalty_gradient(self):
+        # gradient of _penalty_constraints w.r.t. [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2]
+        # persistenceQ = p2 + a2*(lambda^2 + 2*gamma_2*lambda), mapped to x by _chaingradient
+        grad = np.zeros((8,), dtype=float)
+        grad[1] = -self._dpen(-self._sg+1E-10) + self._dpen(self._sg-1)
+        dQ = self._dpen(self.persistenceQ-1)
+        grad[0] = dQ*2*self._a2*(self._la + self._g2)
+        grad[2] = -self._dpen(-self._p1)
+        grad[3] = -self._dpen(-self._a1) + self._dpen(self._a1-1)
+        grad[5] = dQ - self._dpen(-self._p2) + self._dpen(self._p2-1)
+        grad[6] = dQ*(self._la*self._la + 2*self._g2*self._la) - self._dpen(-self._a2) + self._dpen(self._a2-1)
+        grad[7] = dQ*2*self._a2*self._la
+        return grad
 
-        for t in range(1,kdays+1):
-            self.qforecast[t] = var                + self._p2*(self.qforecast[t-1] - var)         
-            self.vforecast[t] = self.qforecast[t]  + self._p1*(self.vforecast[t-1] - self.qforecast[t])   
-            if (self.vforecast[t]<1E-6):
-                self.vforecast[t]=1E-6
-            if (self.qforecast[t]<1E-6):
-                self.qforecast[t]=1E-6
+
+    def _chaingradient(self, grad):
+        # gradient w.r.t. [lambda, sigma, pers. ST, alpha_1, gamma_1, pers. LT, alpha_2, gamma_2] mapped to x
+        if not self._Qpers:
+            return grad
+        # p2 = 1 - alpha_2*(lambda^2 + 2*gamma_2*lambda)
+        gx = np.delete(grad, 5)
+        gx[0] += grad[5]*(-2*self._a2*(self._la + self._g2))
+        gx[5] += grad[5]*(-(self._la*self._la + 2*self._g2*self._la))
+        gx[6] += grad[5]*(-2*self._a2*self._la)
+        return gx
+
+
+    def _score(self, vpath, qpath, W, Z, N):
+        return _numbascorecngarch(self._R, vpath, qpath, W, Z, self._la, self._sg, self._p1, self._a1, self._g1, self._p2, self._a2, self._g2, N)
 
     def filter(self, output="variance", debug=False):
-        np.seterr(all='raise')
-        N = len(self._R)
         penalty = self._penalty_constraints()
         if debug:
             print(f"Penalty = {penalty}")
+        if output in ['estimate', 'gradient']:
+            return self._objective(output, penalty)
+
+        np.seterr(all='raise')
+        N = len(self._R)
         if penalty>0:
-            if output=='estimate':
-                return penalty
-            else:
-                warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
-                # vpath = np.zeros((N,), dtype=float)
-                # qpath = np.zeros((N,), dtype=float)
-                self.qpath = np.zeros((N,), dtype=float)
-                self.vpath = np.zeros((N,), dtype=float)
-                self.success = False
-                return
+            warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
+            # vpath = np.zeros((N,), dtype=float)
+            # qpath = np.zeros((N,), dtype=float)
+            self.qpath = np.zeros((N,), dtype=float)
+            self.vpath = np.zeros((N,), dtype=float)
+            self.success = False
+            return
         
-        vpath = np.zeros((N,), dtype=float)
-        qpath = np.zeros((N,), dtype=float)
+        paths = np.zeros((2,N), dtype=float)
+        vpath, qpath = paths[0], paths[1]
         W     = np.zeros((N,), dtype=float)
         Z     = np.zeros((N,), dtype=float)
 
         vpath[0] = self._sg*self._sg
         if vpath[0]<1E-6:
-            if output=='estimate':
-                return 9999*LA.norm(self.x)
-            else:
-                warnings.warn('The filtering found a negative variance. Filtering might be bad')
-                self.qpath = np.zeros((N,), dtype=float)
-                self.vpath = np.zeros((N,), dtype=float)
-                self.success = False
-                return
+            warnings.warn('The filtering found a negative variance. Filtering might be bad')
+            self.qpath = np.zeros((N,), dtype=float)
+            self.vpath = np.zeros((N,), dtype=float)
+            self.success = False
+            return
         qpath[0] = vpath[0]
 
 
         W[0] = self._R[0] - self._la*sqrt(vpath[0]) + 0.5*vpath[0]
         Z[0] = W[0] / sqrt(vpath[0]) 
 
-        LL, vpath, qpath = _numbafiltercngarch(self._R, vpath, qpath, W, Z, self._la, self._p1, self._a1, self._g1, self._p2, self._a2, self._g2, N)
+        LL = _numbafilter(self._R, paths, W, Z, self._kernelnatural(), N)
         
         self.qpath = qpath
         self.vpath = vpath
         self.loglikelihood = LL
+        self._zlast = Z[-1]
+        return LL
+
+
+
+
+class kngarch(gmodel):
+    """
+        NGARCH model with K nested components, each one reverting to the next longer one and the longest to sigma^2,
+        see _numbafilter. K=1 is ngarch and K=2 cngarch.
+        x=[lambda, sigma (per period), persistence_1, alpha_1, gamma_1, ..., persistence_K, alpha_K, gamma_K]
+        from the shortest component to the longest, without the gammas when asymmetric=False, without sigma when
+        targetV and without alpha_1 when targetK, see garch.
+    """
+    def __init__(self, x:list[float], R=np.zeros((1, )), K:int=3, asymmetric:bool=True, targetK=False,
+                 targetV=False) -> None:
+        super().__init__(x, R=R)
+        self._components = K
+        self._asymmetric = asymmetric
+        self._targetK = targetK
+        self._targetV = targetV
+        self.cpath = np.zeros((K,1), dtype=float)
+        self.cforecast = np.zeros((K,1), dtype=float)
+        self._cwork = np.zeros((K,0), dtype=float)
+        self.set_theta(x)
+
+    def name(self)->str:
+        return 'kngarch'
+
+    def _specification(self)->dict:
+        return {'K':self._components, 'asymmetric':self._asymmetric, 'targetK':self._targetK, 'targetV':self._targetV}
+
+    def __str__(self) -> str:
+        smodel = f"{self._components}-component {'NGARCH' if self._asymmetric else 'GARCH'}(1,1)"
+        smodel = smodel + self._targetdescription() + "\n"
+        sparam = f"[lambda, sigma] = [{self._la}, {self._sg}]\n"
+        for k in range(self._components):
+            sparam = sparam + f"component {k+1}: [persistence, alpha, gamma] = {self._nat[2+3*k:5+3*k].tolist()}\n"
+        return super().__str__() + smodel + sparam
+
+    @property
+    def glabel(self):
+        return f"{self._components}C-{'NGARCH' if self._asymmetric else 'GARCH'}(1,1)" + self._targetlabel()
+
+    @property
+    def uncvol(self):
+        return self._sg
+
+    def set_theta(self, x):
+        full = self._targeted(x)
+        if self._asymmetric:
+            self._nat = full
+        else:
+            self._nat = np.insert(full, np.arange(4, 4 + 2*self._components, 2), 0.0)
+        self._la = self._nat[0]
+        self._sg = self._nat[1]
+        if self._targetK:
+            self._nat[3] = self._targetalpha()
+        return super().set_theta(x)
+
+    @property
+    def persistenceP(self):
+        return self._nat[2]
+
+    @property
+    def persistenceQ(self):
+        # persistence of the longest component
+        pK, aK, gK = self._nat[-3:]
+        return pK + aK*(self._la*self._la + 2*gK*self._la)
+
+    def _natural(self):
+        return self._nat.copy()
+
+    def _penalty_constraints(self):
+        # unc.vol. positive and below 1, persistence of the longest component < 1, persistences and alphas in [0, 1]
+        penalty = self._pen(-self._sg+1E-10) + self._pen(self._sg-1)
+        penalty = penalty + self._pen(self.persistenceQ-1)
+        for k in range(self._components):
+            for value in self._nat[2+3*k:4+3*k]:
+                penalty = penalty + self._pen(-value) + self._pen(value-1)
+        return penalty
+
+    def _penalty_gradient(self):
+        # gradient of _penalty_constraints w.r.t. the natural parameters
+        grad = np.zeros((len(self._nat),), dtype=float)
+        grad[1] = -self._dpen(-self._sg+1E-10) + self._dpen(self._sg-1)
+        pK, aK, gK = self._nat[-3:]
+        dQ = self._dpen(self.persistenceQ-1)
+        grad[0] = dQ*2*aK*(self._la + gK)
+        grad[-3] = dQ
+        grad[-2] = dQ*(self._la*self._la + 2*gK*self._la)
+        grad[-1] = dQ*2*aK*self._la
+        for k in range(self._components):
+            for j in (2+3*k, 3+3*k):
+                grad[j] += -self._dpen(-self._nat[j]) + self._dpen(self._nat[j]-1)
+        return grad
+
+    def _chaingradient(self, grad):
+        # gradient w.r.t. the natural parameters mapped to x, the gammas are not in x of the symmetric model
+        if self._asymmetric:
+            return grad
+        return np.delete(grad, np.arange(4, 2 + 3*self._components, 3))
+
+    def _componentpaths(self)->list:
+        return list(self.cpath)
+
+    def _setcomponentpaths(self, paths:np.ndarray):
+        self.cpath = paths
+        self.vpath = paths[0]
+        if self._components>1:
+            self.qpath = paths[1]
+
+    def _score(self, vpath, qpath, W, Z, N):
+        if np.size(self._cwork,1)!=N:
+            self._cwork = np.zeros((self._components,N), dtype=float)
+        self._cwork[:,0] = vpath[0]
+        return _numbascore(self._R, self._cwork, W, Z, self._nat, N, np.zeros((0, len(self._nat)), dtype=float))
+
+    def filter(self, output="variance", debug=False):
+        penalty = self._penalty_constraints()
+        if debug:
+            print(f"Penalty = {penalty}")
+        if output in ['estimate', 'gradient']:
+            return self._objective(output, penalty)
+
+        N = len(self._R)
+        if penalty>0 or self._sg*self._sg<1E-6:
+            warnings.warn('The set of parameters creates a penalty. Filtering might be bad')
+            self._setcomponentpaths(np.zeros((self._components,N), dtype=float))
+            self.success = False
+            return
+
+        paths = np.zeros((self._components,N), dtype=float)
+        W = np.zeros((N,), dtype=float)
+        Z = np.zeros((N,), dtype=float)
+        var = self._sg*self._sg
+        paths[:,0] = var
+        W[0] = self._R[0] - self._la*sqrt(var) + 0.5*var
+        Z[0] = W[0] / sqrt(var)
+
+        LL = _numbafilter(self._R, paths, W, Z, self._nat, N)
+
+        self._setcomponentpaths(paths)
+        self.loglikelihood = LL
+        self._zlast = Z[-1]
         return LL
 
+    def termstructure(self, horizons, cstart=None):
+        """
+            As gmodel.termstructure, by the forecast recursion of the K components. cstart is the state of every
+            component (the last filtered day by default), or a (K, n) array to forecast from n days at once.
+        """
+        if cstart is None:
+            cstart = self.cpath[:,-1]
+        cstart = np.asarray(cstart, dtype=float)
+        single = cstart.ndim==1
+        c0 = np.ascontiguousarray(np.atleast_2d(cstart.T)) if not single else cstart[None,:].copy()
+        horizons = np.asarray(horizons, dtype=int)
+        forecasts = _numbaforecast(self._nat, c0, int(np.max(horizons)))
+        point = forecasts[:,0,:]
+        cumulative = np.concatenate([np.zeros((len(c0),1)), np.cumsum(point, axis=1)], axis=1)
+        if single:
+            return point[0,horizons], cumulative[0,horizons]
+        return point[:,horizons], cumulative[:,horizons]
+
+    def _termstructureat(self, horizons, days):
+        return self.termstructure(horizons, cstart=self.cpath[:,days])
 
+    def forecast(self, kdays:int)->np.ndarray:
+        # vforecast, qforecast (component 2) and cforecast (every component) for the days 0..kdays
+        if self._zlast is None or not self.vpath[-1]>0:
+            self.filter()
+        self.cforecast = _numbaforecast(self._nat, self.cpath[:,-1][None,:].copy(), kdays)[0]
+        if self._components>1:
+            # component forecasts are floored at 1E-6
+            self.cforecast[:,1:] = np.maximum(self.cforecast[:,1:], 1E-6)
+            self.qforecast = self.cforecast[1]
+        self.vforecast = self.cforecast[0]
 
 
 def _optimize(x, thisset:gmodel):
@@ -848,12 +2024,382 @@ def _optimize(x, thisset:gmodel):
     return LL
 
 
-def _paralelle(thisset:gmodel):
+def _optimizescaled(y, x0, scale, thisset:gmodel):
+    LL, grad = _optimizegradient(x0 + scale*y, thisset)
+    return LL, scale*grad
+
+
+def _optimizegradient(x, thisset:gmodel):
+    thisset.set_theta(x)
+    LL, grad = thisset.filter(output="gradient")
+    if thisset._debug:
+        print(f"{LL}  {thisset.x}")
+
+    return LL, grad
+
+
+def _geometricsum(p:float, h:np.ndarray)->np.ndarray:
+    # sum of p^k for k<h
+    if abs(1 - p)<1E-12:
+        return h
+    return (1 - p**h)/(1 - p)
+
+
+def _termstructure(var:float, p1:float, p2:float, v0:np.ndarray, q0:np.ndarray, h:np.ndarray):
+    # Closed form of the forecast recursion q_h = var + p2*(q_h-1 - var), v_h = q_h + p1*(v_h-1 - q_h):
+    # q_h = var + p2^h*c and v_h = var + p2^h*(c - A) + p1^h*(d + A), with c = q0 - var, d = v0 - q0 and
+    # A = p1*(1 - p2)*c/(p1 - p2). One-component models are the case q0 = var (c = 0).
+    c = q0 - var
+    d = v0 - q0
+    if abs(p1 - p2)>1E-8:
+        A = p1*(1 - p2)*c/(p1 - p2)
+        point = var + (c - A)*p2**h + (d + A)*p1**h
+        cumulative = h*var + (c - A)*_geometricsum(p2, h) + (d + A)*_geometricsum(p1, h)
+    else:
+        # p1 = p2 = p: v_h = var + p^h*(c + d) + (1 - p)*c*h*p^h
+        p = p1
+        B = (1 - p)*c
+        if abs(1 - p)<1E-12:
+            weighted = h*(h - 1)/2
+        else:
+            weighted = p*(1 - h*p**(h - 1) + (h - 1)*p**h)/((1 - p)*(1 - p))
+        point = var + (c + d)*p**h + B*h*p**h
+        cumulative = h*var + (c + d)*_geometricsum(p, h) + B*weighted
+    return point, cumulative
+
+
+def _kurtosisterms(natural:np.ndarray):
+    """
+        (A, B, C) of the kurtosis of the returns implied by the natural parameters of K components,
+        3*E[v^2]/E[v]^2 = 3/(1 - F) with F = A*alpha_1^2 + B*alpha_1 + C. Centred on sigma^2 the components follow
+        c_t = M c_t-1 + v_t-1 * L (Z^2 - 1, Z), so F = sum_ij W_ij L_i diag(2, 1) L_j' with W = M' W M + e_1 e_1'.
+        alpha_1 only loads the shortest component, which makes F quadratic in it. lambda and sigma do not enter.
+    """
+    K = (len(natural) - 2)//3
+    p, a, g = natural[2::3], natural[3::3], natural[4::3]
+    M = np.zeros((K,K), dtype=float)
+    r = np.zeros((K,2), dtype=float)
+    for k in range(K-1, -1, -1):
+        if k<K-1:
+            # c_k reverts to c_k+1 and takes its innovation
+            M[k,:] = M[k+1,:]
+            M[k,k+1] -= p[k]
+            r[k,:] = r[k+1,:]
+        M[k,k] += p[k]
+        if k>0:
+            r[k,:] += a[k]*np.array([1, -2*g[k]])
+    u = np.array([1, -2*g[0]])
+    E = np.zeros((K,K), dtype=float)
+    E[0,0] = 1
+    W = np.linalg.solve(np.eye(K*K) - np.kron(M.T, M.T), E.flatten()).reshape((K,K))
+    S = np.diag([2.0, 1.0])
+    return W[0,0]*(u @ S @ u), 2*(W[0,:] @ (r @ S @ u)), np.sum(W*(r @ S @ r.T))
+
+
+def _growpaths(buffer:np.ndarray, paths:list, n:int)->np.ndarray:
+    # _growbuffer for the component paths, one row of buffer per path
+    N = len(paths[0])
+    if np.size(buffer,0)==len(paths) and np.size(buffer,1)>=n and all(path.base is buffer for path in paths):
+        return buffer
+    grown = np.zeros((len(paths), max(n, 2*N)), dtype=float)
+    for k, path in enumerate(paths):
+        grown[k,:N] = path
+    return grown
+
+
+def _growbuffer(buffer:np.ndarray, path:np.ndarray, n:int)->np.ndarray:
+    # buffer holding path in its first len(path) entries with room for n, reallocated (doubling) only when needed
+    if path.base is buffer and len(buffer)>=n:
+        return buffer
+    grown = np.zeros((max(n, 2*len(path)),), dtype=float)
+    grown[:len(path)] = path
+    return grown
+
+
+class EstimationStats:
+    """
+        Telemetry of one estimate(), or the sum of several (the starts of parallel(), the windows of backtesting()).
+        nestimates: estimations summed, nfev: objective evaluations, nit: optimizer iterations,
+        constrainthits: evaluations charged by _penalty_constraints(), boundhits: evaluations where the variance
+        bounds of the kernels charged a penalty, variancehits: evaluations refused for a starting variance below 1E-6,
+        kerneltime: seconds in the compiled kernels, compiletime: seconds numba spent compiling kernels (included in
+        kerneltime), totaltime: seconds in estimate(), overhead: totaltime - kerneltime, Python and scipy,
+        cachehits: estimations read from an EstimationCache instead of optimized.
+        Objects add up: sum(stats, EstimationStats()).
+    """
+    _fields = ('nestimates', 'nfev', 'nit', 'constrainthits', 'boundhits', 'variancehits',
+               'kerneltime', 'compiletime', 'totaltime', 'cachehits')
+
+    def __init__(self, nestimates:int=0) -> None:
+        self.nestimates = nestimates
+        self.nfev = 0
+        self.nit = 0
+        self.constrainthits = 0
+        self.boundhits = 0
+        self.variancehits = 0
+        self.kerneltime = 0.0
+        self.compiletime = 0.0
+        self.totaltime = 0.0
+        self.cachehits = 0
+
+    @property
+    def overhead(self)->float:
+        return self.totaltime - self.kerneltime
+
+    def __add__(self, other):
+        total = EstimationStats()
+        for field in self._fields:
+            setattr(total, field, getattr(self, field) + getattr(other, field))
+        return total
+
+    def __str__(self) -> str:
+        return (f"{self.nestimates} estimation(s) ({self.cachehits} cached), {self.nfev} evaluations, "
+                f"{self.nit} iterations, "
+                f"penalties: {self.constrainthits} constraints, {self.boundhits} bounds, {self.variancehits} variance, "
+                f"{self.totaltime:.4f}s = {self.kerneltime:.4f}s kernels ({self.compiletime:.4f}s compiling) "
+                f"+ {self.overhead:.4f}s overhead")
+
+    def todict(self)->dict:
+        output = {field:getattr(self, field) for field in self._fields}
+        output['overhead'] = self.overhead
+        return output
+
+    def _compiled(self, seconds:float):
+        self.compiletime += seconds
 
+
+class ModelState:
+    """
+        Compact, picklable record of a model without its return series, paths or optimizer result: the class and
+        its specification, theta, bounds, optimizer and warm-start options, inverse-Hessian, log-likelihood and
+        success. gmodel.to_state() and gmodel.from_state(state, R); the pools, the backtest windows and the
+        checkpoints exchange these instead of whole models.
+    """
+    __slots__ = ('modeltype', 'specification', 'theta', 'bounds', 'options', 'warmoptions', 'hessinv',
+                 'loglikelihood', 'success')
+
+
+class EstimationPool:
+    """
+        Persistent worker pool for multi-start estimation, meant to be created once and reused for every parallel()
+        call (with EstimationPool(4) as pool: model.parallel(estpool=pool)).
+        Each return series is copied once into shared memory, keyed by its content. Workers only receive the name
+        of the segment and the ModelState of the start, and send back
+        (theta, log-likelihood, success, time, inverse-Hessian).
+        The workers are spawned: numba's TBB and OpenMP threading layers do not survive a fork.
+        map() and imap_unordered() are the ones of the underlying pool, so it can also be given to backtesting().
+        race() runs the starts asynchronously and stops early, see parallel(agree=..., deadline=...).
+    """
+    def __init__(self, Ncores:int=4, context:str='spawn') -> None:
+        ctx = mp.get_context(context)
+        # number of the last cancelled race, the workers skip the queued starts of every race up to it
+        self._cancelled = ctx.Value('q', 0)
+        self._races = 0
+        # True once a race left starts running in the workers, close() then terminates them
+        self._abandoned = False
+        self._pool = ctx.Pool(Ncores, initializer=_initworker, initargs=(self._cancelled,))
+        self._shared = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def map(self, func, iterable):
+        return self._pool.map(func, iterable)
+
+    def imap_unordered(self, func, iterable, chunksize:int=1):
+        return self._pool.imap_unordered(func, iterable, chunksize)
+
+    def share(self, R:np.ndarray)->tuple:
+        # (segment name, length) of R in shared memory, copied only the first time this series is seen
+        R = np.ascontiguousarray(R, dtype=float)
+        key = hashlib.sha1(R.tobytes()).hexdigest()
+        if key not in self._shared:
+            shm = shared_memory.SharedMemory(create=True, size=max(R.nbytes, 1))
+            np.ndarray(R.shape, dtype=float, buffer=shm.buf)[:] = R
+            self._shared[key] = shm
+        return self._shared[key].name, len(R)
+
+    def release(self):
+        # free every shared series
+        for shm in self._shared.values():
+            shm.close()
+            shm.unlink()
+        self._shared = {}
+
+    def estimate(self, model:gmodel, thetas:np.ndarray):
+        # estimate model from every row of thetas,
+        # returns (thetas, log-likelihoods, success, timers, inverse-Hessians, EstimationStats)
+        name, N = self.share(model.R)
+        thetas = np.atleast_2d(thetas)
+        tasks = [(name, N, model.to_state(thetas[iest,:])) for iest in range(np.size(thetas,0))]
+        output = self._pool.map(_estimatestart, tasks)
+        thetaout = np.array([out[0] for out in output], dtype=float)
+        best = np.array([out[1] for out in output], dtype=float)
+        worked = [out[2] for out in output]
+        timers = np.array([out[3] for out in output], dtype=float)
+        hessinvs = [out[4] for out in output]
+        stats = [out[5] for out in output]
+        return thetaout, best, worked, timers, hessinvs, stats
+
+    def race(self, model:gmodel, thetas:np.ndarray, agree:int=None, tolerance:float=1E-3, deadline:float=None):
+        """
+            As estimate(), but the starts are collected as they finish (imap_unordered) and the race stops once agree
+            successful starts are within tolerance of the best log-likelihood, or deadline seconds after the call.
+            The queued starts are then skipped by the workers; the ones already running finish in the background and
+            are discarded. Returns (indices of the finished starts in thetas, thetas, log-likelihoods, success, timers,
+            inverse-Hessians, EstimationStats) of the finished starts only.
+        """
+        start = time.perf_counter()
+        name, N = self.share(model.R)
+        thetas = np.atleast_2d(thetas)
+        nbest = np.size(thetas,0)
+        self._races += 1
+        tasks = [(self._races, iest, (name, N, model.to_state(thetas[iest,:]))) for iest in range(nbest)]
+        output = _race(self._pool.imap_unordered(_racestart, tasks), nbest, agree, tolerance, deadline, start)
+        if len(output)<nbest:
+            with self._cancelled.get_lock():
+                self._cancelled.value = self._races
+            self._abandoned = True
+        return _raceresults(output)
+
+    def close(self):
+        if self._abandoned:
+            # only starts of cut races can still be running
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+        self.release()
+
+
+class EstimationThreadPool(EstimationPool):
+    """
+        EstimationPool of threads in this process: every start is a new model (from its ModelState) on the same
+        return array, nothing is copied or pickled and no worker is spawned. The kernels run without the GIL, the
+        optimizer's Python and scipy code still holds it, so the threads scale with the kernel share of an estimation
+        (EstimationStats.kerneltime/totaltime, higher on long series).
+        Same interface as EstimationPool, parallel(backend='thread') and backtesting(backend='thread') create one.
+        Threads cannot be terminated: the starts of a cut race that are already running finish before close() returns.
+    """
+    def __init__(self, Ncores:int=4) -> None:
+        self._cancelled = 0
+        self._races = 0
+        self._abandoned = False
+        self._pool = ThreadPool(Ncores)
+        self._shared = {}
+
+    def estimate(self, model:gmodel, thetas:np.ndarray):
+        R = model.R
+        thetas = np.atleast_2d(thetas)
+        states = [model.to_state(thetas[iest,:]) for iest in range(np.size(thetas,0))]
+        output = self._pool.map(lambda state: _estimatestate(state, R), states)
+        return _raceresults(dict(enumerate(output)))[1:]
+
+    def race(self, model:gmodel, thetas:np.ndarray, agree:int=None, tolerance:float=1E-3, deadline:float=None):
+        start = time.perf_counter()
+        R = model.R
+        thetas = np.atleast_2d(thetas)
+        nbest = np.size(thetas,0)
+        self._races += 1
+        race = self._races
+        states = [model.to_state(thetas[iest,:]) for iest in range(nbest)]
+        def racestart(iest):
+            # the queued starts of a cancelled race are skipped
+            if self._cancelled>=race:
+                return iest, None
+            return iest, _estimatestate(states[iest], R)
+        output = _race(self._pool.imap_unordered(racestart, range(nbest)), nbest, agree, tolerance, deadline, start)
+        if len(output)<nbest:
+            self._cancelled = race
+        return _raceresults(output)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.release()
+
+
+def _estimationpool(Ncores:int, backend:str)->EstimationPool:
+    # the pool parallel() and backtesting() create when none is given: 'process' or 'thread'
+    if backend=='process':
+        return EstimationPool(Ncores)
+    if backend=='thread':
+        return EstimationThreadPool(Ncores)
+    raise Exception(f"Unknown backend {backend}, use 'process' or 'thread'.")
+
+
+def _estimatestart(task):
+    # worker side of EstimationPool.estimate: one start (a ModelState) on a series read from shared memory
+    name, N, state = task
+    shm = shared_memory.SharedMemory(name=name)
+    R = np.ndarray((N,), dtype=float, buffer=shm.buf).copy()
+    shm.close()
+    return _estimatestate(state, R)
+
+
+def _estimatestate(state, R:np.ndarray)->tuple:
+    # estimate the model of state on R, returns (theta, log-likelihood, success, time, inverse-Hessian, EstimationStats)
+    model = gmodel.from_state(state, R)
     start = time.perf_counter()
-    thisset.estimate()
-    thisset._estimationtime = time.perf_counter() - start
-    return thisset
+    model.estimate()
+    return np.array(model.x, dtype=float), model.loglikelihood, model.success, time.perf_counter() - start, model._hessinv, model.stats
+
+
+def _statestart(task):
+    # worker side of parallel() on the other pools: (index, output of _estimatestate)
+    index, state, R = task
+    return index, _estimatestate(state, R)
+
+
+# the race counter of the EstimationPool in a worker, see _initworker
+_cancelledrace = None
+
+
+def _initworker(cancelled):
+    global _cancelledrace
+    _cancelledrace = cancelled
+
+
+def _racestart(task):
+    # worker side of EstimationPool.race: (index, output of _estimatestart), output is None for a skipped start
+    race, index, start = task
+    if _cancelledrace is not None and _cancelledrace.value>=race:
+        return index, None
+    return index, _estimatestart(start)
+
+
+def _race(results, nbest:int, agree:int, tolerance:float, deadline:float, start:float)->dict:
+    # {index: output} of the (index, output) pairs of results as they finish, until agree successful starts are within
+    # tolerance of the best log-likelihood, all nbest are in, or deadline seconds after start
+    finished = {}
+    while len(finished)<nbest:
+        timeout = None if deadline is None else max(deadline - (time.perf_counter() - start), 0.0)
+        try:
+            index, output = results.next(timeout)
+        except mp.TimeoutError:
+            break
+        finished[index] = output
+        if agree is not None:
+            lls = np.array([out[1] for out in finished.values() if out[2]])
+            if len(lls)>0 and np.sum(lls<=np.min(lls) + tolerance)>=agree:
+                break
+    return finished
+
+
+def _raceresults(finished:dict):
+    # the outputs of _race as the arrays of EstimationPool.estimate, in the order of the starts
+    indices = sorted(finished)
+    output = [finished[index] for index in indices]
+    thetaout = np.array([out[0] for out in output], dtype=float)
+    best = np.array([out[1] for out in output], dtype=float)
+    worked = [out[2] for out in output]
+    timers = np.array([out[3] for out in output], dtype=float)
+    hessinvs = [out[4] for out in output]
+    stats = [out[5] for out in output]
+    return np.array(indices, dtype=int), thetaout, best, worked, timers, hessinvs, stats
 
 
 
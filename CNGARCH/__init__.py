@@ -1,2 +1,5 @@
-from .cngarch import *
-from .backtesting import *
\ No newline at end of file
+from .CNGARCH import *
+from .backtesting import *
+from .panel import *
+from .cache import *
+from .bank import *
\ No newline at end of file
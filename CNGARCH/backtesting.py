@@ -1,8 +1,12 @@
 from typing import Union
 import numpy as np
-from .cngarch import *
+from .CNGARCH import *
+from .CNGARCH import _estimationpool
 import multiprocessing as mp
-from sklearn import metrics
+import hashlib
+import json
+import os
+import time
 
 WINDOW_TYPE_ROLLING = 0
 WINDOW_TYPE_GROWING = 1
@@ -13,64 +17,316 @@ PEAKDREALIZEDVARIANCE = 1
 ESTIMATE_METHOD_ONE_THETA = 0
 ESTIMATE_METHOD_PARALLEL_ONCE = 1
 ESTIMATE_METHOD_PARALLEL_ALL = 2
+ESTIMATE_METHOD_WARM_START = 3
+ESTIMATE_METHOD_FIXED = 4
+
+
+def realizedtargets(Returns:np.ndarray, estimatewindowsize:int, forecasthorizon:Union[int, np.ndarray]=1,
+                    longerhorizontype:int=TOTALREALIZEDVARIANCE, proxy:np.ndarray=None)->np.ndarray:
+    """
+        The realized targets of backtesting(), aligned with its windows: row index, column k covers the
+        forecasthorizon[k] days after the estimation window of window index, days estimatewindowsize+index onwards.
+        TOTALREALIZEDVARIANCE sums the daily variance proxy over those days, PEAKDREALIZEDVARIANCE takes its maximum.
+        proxy defaults to the squared returns, any daily variance proxy of the same length can be given instead
+        (e.g. squared log-changes of the hilow column of the CSVs, or a range-based estimator).
+        A 2D Returns (or proxy) has one asset per column, the targets are then shaped (nwindows, nforecast, nassets).
+        Cumulative sums, and block prefix/suffix maxima for the peaks, make every horizon O(N).
+    """
+    forecasthorizon = np.atleast_1d(forecasthorizon)
+    if proxy is None:
+        proxy = np.asarray(Returns, dtype=float)**2
+    proxy = np.asarray(proxy, dtype=float)
+    nwindows = np.size(proxy,0)-estimatewindowsize-np.max(forecasthorizon)+1
+    first = estimatewindowsize + np.arange(nwindows)
+
+    Real = np.zeros((nwindows, len(forecasthorizon)) + proxy.shape[1:], dtype=float)
+    if longerhorizontype==TOTALREALIZEDVARIANCE:
+        cumulative = np.concatenate([np.zeros((1,) + proxy.shape[1:]), np.cumsum(proxy, axis=0)], axis=0)
+        for index, ihor in enumerate(forecasthorizon):
+            Real[:,index] = cumulative[first + ihor] - cumulative[first]
+    elif longerhorizontype==PEAKDREALIZEDVARIANCE:
+        for index, ihor in enumerate(forecasthorizon):
+            Real[:,index] = _slidingmax(proxy, ihor)[first]
+    else:
+        raise Exception('This is an invalid longer horizon type, please use the constants.')
+    return Real
+
+
+def _slidingmax(x:np.ndarray, h:int)->np.ndarray:
+    # max of x[j:j+h] along the first axis for every j (van Herk/Gil-Werman): within blocks of h days, the
+    # maximum from j to the end of its block and from the start of the next block to j+h-1
+    N = np.size(x,0)
+    nblocks = -(-N//h)
+    padded = np.full((nblocks*h,) + x.shape[1:], -np.inf)
+    padded[:N] = x
+    blocks = padded.reshape((nblocks, h) + x.shape[1:])
+    prefix = np.maximum.accumulate(blocks, axis=1).reshape(padded.shape)
+    suffix = np.maximum.accumulate(blocks[:,::-1], axis=1)[:,::-1].reshape(padded.shape)
+    return np.maximum(suffix[:N-h+1], prefix[h-1:N])
+
+
+class ForecastMetrics:
+    """
+        Forecast evaluation metrics of every horizon, updated one window at a time with update(real, forecast).
+        Running means and sums of squares (Welford) are kept instead of the forecasts, results() can be read at any
+        time during a backtest: {horizon: {'Rsquare', 'RMSE', 'evs', 'mae', 'mape', 'qlike', 'n'}}, the definitions
+        of sklearn.metrics for the first five. qlike is the mean of real/forecast - log(real/forecast) - 1.
+    """
+    def __init__(self, forecasthorizon:Union[int, np.ndarray]) -> None:
+        self.forecasthorizon = np.atleast_1d(forecasthorizon)
+        nforecast = len(self.forecasthorizon)
+        self.n = 0
+        self._meanreal = np.zeros((nforecast,), dtype=float)
+        self._m2real = np.zeros((nforecast,), dtype=float)
+        self._meanerror = np.zeros((nforecast,), dtype=float)
+        self._m2error = np.zeros((nforecast,), dtype=float)
+        self._sse = np.zeros((nforecast,), dtype=float)
+        self._sae = np.zeros((nforecast,), dtype=float)
+        self._sape = np.zeros((nforecast,), dtype=float)
+        self._sqlike = np.zeros((nforecast,), dtype=float)
+
+    def update(self, real:np.ndarray, forecast:np.ndarray):
+        # real and forecast of one window for every horizon, or of several windows (one per row)
+        # several windows are merged as one batch (Chan et al.), the sums of squares of the batch around its own means
+        real = np.atleast_2d(np.asarray(real, dtype=float))
+        forecast = np.atleast_2d(np.asarray(forecast, dtype=float))
+        nbatch = np.size(real,0)
+        if nbatch==0:
+            return
+        nbefore = self.n
+        self.n += nbatch
+        error = real - forecast
+        for mean, m2, values in ((self._meanreal, self._m2real, real), (self._meanerror, self._m2error, error)):
+            batchmean = np.mean(values, axis=0)
+            delta = batchmean - mean
+            m2 += np.sum((values - batchmean)**2, axis=0) + delta*delta*nbefore*nbatch/self.n
+            mean += delta*nbatch/self.n
+        self._sse += np.sum(error*error, axis=0)
+        self._sae += np.sum(np.abs(error), axis=0)
+        self._sape += np.sum(np.abs(error)/np.maximum(np.abs(real), np.finfo(np.float64).eps), axis=0)
+        # QLIKE is undefined (nan) once a forecast is not positive, filter() may have left np.seterr at 'raise'
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = real/forecast
+            self._sqlike += np.sum(ratio - np.log(ratio) - 1, axis=0)
+
+    def results(self)->dict:
+        # a constant real series gives R-square and evs of 1 for perfect forecasts and 0 otherwise, as sklearn
+        output = {}
+        n = max(self.n, 1)
+        for index, ihor in enumerate(self.forecasthorizon):
+            if self._m2real[index]>0:
+                Rsquare = 1 - self._sse[index]/self._m2real[index]
+                evs = 1 - self._m2error[index]/self._m2real[index]
+            else:
+                Rsquare = 1.0 if self._sse[index]==0 else 0.0
+                evs = 1.0 if self._m2error[index]==0 else 0.0
+            output[ihor] = {'Rsquare':Rsquare, 'RMSE':np.sqrt(self._sse[index]/n), 'evs':evs,
+                            'mae':self._sae[index]/n, 'mape':self._sape[index]/n, 'qlike':self._sqlike[index]/n,
+                            'n':self.n}
+        return output
+
+
+class BacktestStore:
+    """
+        Per-window results of a backtesting() run, one .npy file per field in the directory path, opened as
+        memory maps: theta, hessinv (the optimizer's inverse-Hessian, nan when there is none), loglikelihood,
+        success, forecast (one column per horizon), time (seconds per window), nfev and done. The starting estimate
+        of the run is kept in starttheta, starthessinv and started, the configuration in config.json.
+        BacktestStore(path) opens a finished or running store read-only for analysis, without copying.
+        backtesting(..., store=path) writes every window as it is forecast and, run again with the same
+        configuration, skips the windows already done.
+    """
+    _fields = ('theta', 'hessinv', 'loglikelihood', 'success', 'forecast', 'time', 'nfev', 'done',
+               'starttheta', 'starthessinv', 'started')
+
+    def __init__(self, path:str, mode:str='r') -> None:
+        self.path = path
+        with open(os.path.join(path, 'config.json')) as f:
+            self.config = json.load(f)
+        for field in self._fields:
+            setattr(self, field, np.load(os.path.join(path, f"{field}.npy"), mmap_mode=mode))
+
+    @staticmethod
+    def create(path:str, config:dict, nwindows:int, ntheta:int, nforecast:int):
+        # open the store of this configuration in path for writing, created when absent
+        if os.path.exists(os.path.join(path, 'config.json')):
+            store = BacktestStore(path, 'r+')
+            if store.config!=config:
+                raise Exception(f'The backtest store {path} holds a different configuration.')
+            return store
+        os.makedirs(path, exist_ok=True)
+        nwindows, ntheta, nforecast = int(nwindows), int(ntheta), int(nforecast)
+        shapes = {'theta':((nwindows, ntheta), float), 'hessinv':((nwindows, ntheta, ntheta), float),
+                  'loglikelihood':((nwindows,), float), 'success':((nwindows,), bool),
+                  'forecast':((nwindows, nforecast), float), 'time':((nwindows,), float), 'nfev':((nwindows,), int),
+                  'done':((nwindows,), bool), 'starttheta':((ntheta,), float),
+                  'starthessinv':((ntheta, ntheta), float), 'started':((1,), bool)}
+        for field in BacktestStore._fields:
+            shape, dtype = shapes[field]
+            np.lib.format.open_memmap(os.path.join(path, f"{field}.npy"), mode='w+', dtype=dtype, shape=shape).flush()
+        # written last: a store without config.json is incomplete and created again
+        with open(os.path.join(path, 'config.json'), 'w') as f:
+            json.dump(config, f)
+        return BacktestStore(path, 'r+')
+
+    @property
+    def completed(self)->int:
+        return int(np.sum(self.done))
+
+    def write(self, index:int, model:gmodel, forecast:np.ndarray, seconds:float):
+        # the results of window index (the ModelState of model), marked done once every other field is on disk
+        state = model.to_state()
+        self.theta[index,:] = state.theta
+        self.hessinv[index,:,:] = np.nan if state.hessinv is None else state.hessinv
+        self.loglikelihood[index] = state.loglikelihood
+        self.success[index] = state.success
+        self.forecast[index,:] = forecast
+        self.time[index] = seconds
+        self.nfev[index] = model.stats.nfev
+        for field in self._fields[:-4]:
+            getattr(self, field).flush()
+        self.done[index] = True
+        self.done.flush()
+
+    def restore(self, index:int, model:gmodel):
+        # put model back in the state it had after window index, the next warm start then proceeds as it did
+        state = model.to_state()
+        state.theta = np.array(self.theta[index,:])
+        state.hessinv = None if np.isnan(self.hessinv[index,0,0]) else np.array(self.hessinv[index,:,:])
+        state.loglikelihood = float(self.loglikelihood[index])
+        state.success = bool(self.success[index])
+        model.set_state(state)
+
+    def writestart(self, model:gmodel):
+        state = model.to_state()
+        self.starttheta[:] = state.theta
+        self.starthessinv[:,:] = np.nan if state.hessinv is None else state.hessinv
+        self.starttheta.flush()
+        self.starthessinv.flush()
+        self.started[0] = True
+        self.started.flush()
+
+    def restorestart(self, model:gmodel):
+        state = model.to_state()
+        state.theta = np.array(self.starttheta)
+        state.hessinv = None if np.isnan(self.starthessinv[0,0]) else np.array(self.starthessinv)
+        model.set_state(state)
+
+
+def _storeconfig(model:gmodel, Returns:np.ndarray, windowtype:int, estimatewindowsize:int, estimatemethod:int,
+                 forecasthorizon:np.ndarray, parallelwindows:bool, Ncores:int)->dict:
+    # everything a backtest's results depend on, parallel windows are split in Ncores chunks
+    return {'model':model.name(), 'x':[float(value) for value in model.x], 'specification':model._specification(),
+            'bounds':None if model.OptimizationBounds is None else [list(bound) for bound in model.OptimizationBounds],
+            'returns':hashlib.sha1(np.ascontiguousarray(Returns, dtype=float).tobytes()).hexdigest(),
+            'windowtype':windowtype, 'estimatewindowsize':estimatewindowsize, 'estimatemethod':estimatemethod,
+            'forecasthorizon':[int(ihor) for ihor in forecasthorizon], 'parallelwindows':parallelwindows,
+            'Ncores':Ncores if parallelwindows else None}
+
 
 def backtesting(
-    model:gmodel, Returns:np.ndarray, Real:np.ndarray, windowtype:int=WINDOW_TYPE_ROLLING, estimatewindowsize:int=2000, 
+    model:gmodel, Returns:np.ndarray, Real:np.ndarray=None, windowtype:int=WINDOW_TYPE_ROLLING, estimatewindowsize:int=2000, 
     estimatemethod:int=ESTIMATE_METHOD_PARALLEL_ONCE, Ncores:int=4, estpool=None, 
-    forecasthorizon:Union[int, np.ndarray]=1, longerhorizontype:int=TOTALREALIZEDVARIANCE)->dict:
+    forecasthorizon:Union[int, np.ndarray]=1, longerhorizontype:int=TOTALREALIZEDVARIANCE, parallelwindows:bool=False,
+    metrics:ForecastMetrics=None, store:str=None, backend:str='process')->dict:
     """
         This function will backtest the gmodel forecast and return the detailed results in a big dict
         The model needs to be initialized with current parameters, thetas if 
+        Without Real, the targets are built from the squared returns by realizedtargets() with longerhorizontype.
+        With ESTIMATE_METHOD_WARM_START, the first window is estimated normally (multi-start when a pool is given)
+        and every following window starts from the previous optimum and inverse-Hessian, see model.WarmStartOptions
+        With parallelwindows=True, the first window is estimated with estimatemethod, then the test period is split in
+        Ncores contiguous chunks, each one backtested in a worker of the pool with its own copy of the model. Inside the
+        chunks every window is warm started, whatever estimatemethod (ESTIMATE_METHOD_PARALLEL_ALL is refused).
+        A pool created here is an EstimationPool (backend='process') or an EstimationThreadPool (backend='thread'),
+        closed before returning. The workers of an EstimationPool are spawned: numba's TBB and OpenMP threading layers
+        do not survive a fork once a parallel kernel (screenthetas) has run. A pool passed in estpool should be one of
+        the two or spawned too, or numba should run with the 'workqueue' layer. The threads share Returns as is.
+        output['stats'] is the EstimationStats of every estimation of the run, summed.
+        The metrics are accumulated in a ForecastMetrics as the windows are forecast, give one in metrics to read
+        metrics.results() while the backtest runs (parallel windows are accumulated when their chunk returns).
+        With store (a directory), every window is written to a BacktestStore as it is done, and a run with the same
+        configuration resumes after the windows already in the store.
+        With ESTIMATE_METHOD_FIXED, theta is held at model.x: the whole sample is filtered once and every window is
+        forecast from the filtered state of its last day, all windows and horizons in one closed-form call. For
+        WINDOW_TYPE_ROLLING the state then carries the history before the window, the refiltered windows would differ
+        only by their starting variance. There is no estimation to run in parallel or to store.
     """
 
-    if estimatemethod in [ESTIMATE_METHOD_PARALLEL_ONCE, ESTIMATE_METHOD_PARALLEL_ALL]:
+    if parallelwindows and estimatemethod==ESTIMATE_METHOD_PARALLEL_ALL:
+        raise Exception('The windows cannot be run in parallel when every window uses the pool for multi-starts.')
+    if estimatemethod==ESTIMATE_METHOD_FIXED and (parallelwindows or store is not None):
+        raise Exception('The fixed-parameter backtest is one filter pass, it has no parallel windows or store.')
+
+    ownpool = False
+    if parallelwindows or estimatemethod in [ESTIMATE_METHOD_PARALLEL_ONCE, ESTIMATE_METHOD_PARALLEL_ALL]:
         if estpool is None:
-            estpool = mp.Pool(Ncores)
+            estpool = _estimationpool(Ncores, backend)
+            ownpool = True
 
+    forecasthorizon = np.atleast_1d(forecasthorizon)
     totalnbdays = np.size(Returns,0)
     output = {}
     maxforecast = np.max(forecasthorizon)
     nforecast = len(forecasthorizon)
+    nwindows = totalnbdays-estimatewindowsize-maxforecast+1
+    if Real is None:
+        Real = realizedtargets(Returns, estimatewindowsize, forecasthorizon, longerhorizontype)
+    if metrics is None:
+        metrics = ForecastMetrics(forecasthorizon)
+    storepath = store
+    if store is not None:
+        config = _storeconfig(model, Returns, windowtype, estimatewindowsize, estimatemethod, forecasthorizon,
+                              parallelwindows, Ncores)
+        store = BacktestStore.create(storepath, config, nwindows, len(model.x), nforecast)
 
-    if estimatemethod==ESTIMATE_METHOD_PARALLEL_ONCE:
-        model.R = Returns[:(estimatewindowsize)]
-        model.parallel(estpool=estpool)
-
-    model_forecast = np.zeros((totalnbdays-estimatewindowsize-maxforecast+1,nforecast))
-    bench_forecast = np.zeros((totalnbdays-estimatewindowsize-maxforecast+1,nforecast))
-
-    for index in range(totalnbdays-estimatewindowsize-maxforecast+1):
-        if windowtype==WINDOW_TYPE_ROLLING:
-            model.R = Returns[index:(estimatewindowsize+index)]
-        elif windowtype==WINDOW_TYPE_GROWING:
-            model.R = Returns[:(estimatewindowsize+index)]
-        else:
-            raise Exception('This is an invalid window type, please use the constants.')
-        
-        if estimatemethod==ESTIMATE_METHOD_PARALLEL_ALL:
+    stats = EstimationStats()
+    try:
+        if estimatemethod==ESTIMATE_METHOD_FIXED:
+            pass
+        elif store is not None and store.started[0]:
+            store.restorestart(model)
+        elif estimatemethod==ESTIMATE_METHOD_PARALLEL_ONCE:
+            model.R = Returns[:(estimatewindowsize)]
             model.parallel(estpool=estpool)
-        else:
-            model.estimate()
-
-        model.forecast(maxforecast)
-
-        for ih, ihor in enumerate(forecasthorizon):
-            model_forecast[index,ih] = np.sum(model.vforecast[:ihor])
+            stats = model.stats
+        elif estimatemethod==ESTIMATE_METHOD_WARM_START or parallelwindows:
+            model.R = Returns[:(estimatewindowsize)]
+            if estpool is None or estimatemethod==ESTIMATE_METHOD_ONE_THETA:
+                model.estimate()
+            else:
+                model.parallel(estpool=estpool)
+            stats = model.stats
+        if store is not None:
+            store.writestart(model)
 
-        pausehere=1
+        bench_forecast = np.zeros((nwindows,nforecast))
 
-    # compute the R-square, RMSE, and MAE
+        if estimatemethod==ESTIMATE_METHOD_FIXED:
+            model_forecast = _backtestfixed(model, Returns, estimatewindowsize, nwindows, forecasthorizon)
+            metrics.update(Real[:nwindows,:], model_forecast)
+        elif parallelwindows:
+            tasks = []
+            for chunk in np.array_split(np.arange(nwindows), Ncores):
+                if len(chunk)>0:
+                    tasks.append((model.to_state(), Returns, windowtype, estimatewindowsize, ESTIMATE_METHOD_WARM_START, chunk[0], chunk[-1]+1, forecasthorizon, storepath))
+            chunks = estpool.map(_backtestchunk, tasks)
+            model_forecast = np.concatenate([chunk[0] for chunk in chunks], axis=0)
+            stats = sum([chunk[1] for chunk in chunks], stats)
+            metrics.update(Real[:nwindows,:], model_forecast)
+        else:
+            monitor = lambda index, forecast: metrics.update(Real[index,:], forecast)
+            model_forecast, chunkstats = _backtestchunk((model, Returns, windowtype, estimatewindowsize, estimatemethod, 0, nwindows, forecasthorizon, storepath), estpool, monitor)
+            stats = stats + chunkstats
+    finally:
+        if ownpool:
+            estpool.close()
 
+    output['stats'] = stats
+    results = metrics.results()
     for index, ihor in enumerate(forecasthorizon):
-        # look at HAR code to get the metrics.
-        model_Rsquare = metrics.r2_score(Real[:,index], model_forecast[:,index])
-        model_RMSE = np.sqrt(metrics.mean_squared_error(Real[:,index], model_forecast[:,index]))
-        model_evs = metrics.explained_variance_score(Real[:,index], model_forecast[:,index])
-        model_mae = metrics.mean_absolute_error(Real[:,index], model_forecast[:,index])
-        model_mape = metrics.mean_absolute_percentage_error(Real[:,index], model_forecast[:,index])
-
-
-        output[ihor] = {'model':{'Rsquare':model_Rsquare, 'RMSE':model_RMSE, 'evs':model_evs, 'forecast':model_forecast[:,index], 'mae':model_mae, 'mape':model_mape}}
+        output[ihor] = {'model':results[ihor]}
+        output[ihor]['model']['forecast'] = model_forecast[:,index]
     # package a nice dict 
 
     pausebeforereturn = 1
@@ -78,6 +334,58 @@ def backtesting(
     return output
 
 
+def _backtestfixed(model:gmodel, Returns:np.ndarray, estimatewindowsize:int, nwindows:int,
+                   forecasthorizon:np.ndarray)->np.ndarray:
+    # ESTIMATE_METHOD_FIXED: one filter pass over every window, then the forecasts of every window from the state
+    # of its last day, O(days + windows*horizons) instead of a filter per window
+    model.R = Returns[:(estimatewindowsize+nwindows-1)]
+    model.filter()
+    point, cumulative = model._termstructureat(forecasthorizon, np.arange(nwindows) + estimatewindowsize - 1)
+    return cumulative
 
 
+def _backtestchunk(task, estpool=None, monitor=None)->tuple:
+    # Backtest the windows [start, stop) with one model (or a ModelState, in the workers of parallel windows),
+    # returns the forecasts for every horizon and the EstimationStats of the windows.
+    # monitor(index, forecast) is called as every window is forecast.
+    # With a store, the windows done are read back and the others written as they are done
+    model, Returns, windowtype, estimatewindowsize, estimatemethod, start, stop, forecasthorizon, storepath = task
+    if isinstance(model, ModelState):
+        model = gmodel.from_state(model)
+    model_forecast = np.zeros((stop-start,len(forecasthorizon)))
+    stats = EstimationStats()
+    store = None if storepath is None else BacktestStore(storepath, 'r+')
+
+    for index in range(start, stop):
+        if store is not None and store.done[index]:
+            store.restore(index, model)
+            model_forecast[index-start,:] = store.forecast[index,:]
+            if monitor is not None:
+                monitor(index, model_forecast[index-start,:])
+            continue
+
+        windowstart = time.perf_counter()
+        if windowtype==WINDOW_TYPE_ROLLING:
+            model.R = Returns[index:(estimatewindowsize+index)]
+        elif windowtype==WINDOW_TYPE_GROWING:
+            model.R = Returns[:(estimatewindowsize+index)]
+        else:
+            raise Exception('This is an invalid window type, please use the constants.')
+        
+        if estimatemethod==ESTIMATE_METHOD_PARALLEL_ALL:
+            model.parallel(estpool=estpool)
+        elif estimatemethod==ESTIMATE_METHOD_WARM_START:
+            model.estimate(optimizer='warmstart')
+        else:
+            model.estimate()
+        stats = stats + model.stats
+
+        # the paths are left at the last point the optimizer tried, filter at the estimate before forecasting
+        model.filter()
+        point, model_forecast[index-start,:] = model.termstructure(forecasthorizon)
+        if store is not None:
+            store.write(index, model, model_forecast[index-start,:], time.perf_counter() - windowstart)
+        if monitor is not None:
+            monitor(index, model_forecast[index-start,:])
 
+    return model_forecast, stats
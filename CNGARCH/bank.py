@@ -0,0 +1,95 @@
+import numpy as np
+from .CNGARCH import *
+from .CNGARCH import _numbabank
+
+
+class ModelBank:
+    """
+        Fixed-parameter filter and forecasts of many assets in one call of a parallel compiled kernel, for the daily
+        refresh of a universe without a model object (and its arrays) per asset.
+        The parameters are held as a struct of arrays over the assets, la and sg shaped (assets,), persistence, alpha
+        and gamma shaped (assets, K) from the shortest component to the longest, the natural parameters of kngarch.
+        R is an (assets, days) matrix, every row filtered from its first day as model.filter() would.
+        After filter() or forecast(kdays): cpath (K, assets, days) with vpath = cpath[0] and qpath = cpath[1],
+        loglikelihood (assets,), and cforecast (K, assets, kdays+1) with vforecast and qforecast, as in kngarch.
+        The constraints of the models are not checked, the variance bounds of the kernels apply.
+    """
+    def __init__(self, natural:np.ndarray, R:np.ndarray) -> None:
+        # natural: one row [lambda, sigma, pers_1, alpha_1, gamma_1, ..., pers_K, alpha_K, gamma_K] per asset
+        natural = np.atleast_2d(np.asarray(natural, dtype=float))
+        self.la = np.ascontiguousarray(natural[:,0])
+        self.sg = np.ascontiguousarray(natural[:,1])
+        self.persistence = np.ascontiguousarray(natural[:,2::3])
+        self.alpha = np.ascontiguousarray(natural[:,3::3])
+        self.gamma = np.ascontiguousarray(natural[:,4::3])
+        self.R = R
+        self.loglikelihood = np.zeros((len(self.la),), dtype=float)
+        self.cpath = np.zeros((self.components, len(self.la), 1), dtype=float)
+        self.cforecast = np.zeros((self.components, len(self.la), 1), dtype=float)
+
+    @staticmethod
+    def from_models(models:list, R:np.ndarray=None):
+        """
+            The bank of the natural parameters of models, on R or on the stacked R of the models (same length).
+            Models with fewer components get constant components at sigma^2 (no alpha), which leave their recursion
+            unchanged: a garch in a bank of cngarch has qpath = sigma^2.
+        """
+        naturals = [model._kernelnatural() for model in models]
+        K = max((len(natural) - 2)//3 for natural in naturals)
+        natural = np.zeros((len(models), 2 + 3*K), dtype=float)
+        for iasset, row in enumerate(naturals):
+            natural[iasset,:len(row)] = row
+        if R is None:
+            R = np.stack([model.R for model in models])
+        return ModelBank(natural, R)
+
+    def __len__(self)->int:
+        return len(self.la)
+
+    @property
+    def components(self)->int:
+        return self.persistence.shape[1]
+
+    @property
+    def R(self):
+        return self._R
+
+    @R.setter
+    def R(self, value):
+        value = np.ascontiguousarray(np.atleast_2d(value), dtype=float)
+        if np.size(value,0)!=len(self.la):
+            raise Exception(f"R has {np.size(value,0)} rows for {len(self.la)} assets.")
+        self._R = value
+
+    @property
+    def vpath(self):
+        return self.cpath[0]
+
+    @property
+    def qpath(self):
+        return self.cpath[1] if self.components>1 else None
+
+    @property
+    def vforecast(self):
+        return self.cforecast[0]
+
+    @property
+    def qforecast(self):
+        return self.cforecast[1] if self.components>1 else None
+
+    def filter(self)->np.ndarray:
+        # the paths of every asset, returns loglikelihood (negative, as model.loglikelihood)
+        self.forecast(0)
+        return self.loglikelihood
+
+    def forecast(self, kdays:int)->np.ndarray:
+        # filter every asset and forecast its components for the days 0..kdays after the last day, in the same pass
+        K, nassets, N = self.components, len(self.la), np.size(self._R,1)
+        self.cpath = np.empty((K, nassets, N), dtype=float)
+        self.cforecast = np.empty((K, nassets, kdays+1), dtype=float)
+        self.loglikelihood = _numbabank(self._R, self.la, self.sg, self.persistence, self.alpha, self.gamma,
+                                        self.cpath, self.cforecast)
+        if K>1:
+            # component forecasts are floored at 1E-6
+            self.cforecast[:,:,1:] = np.maximum(self.cforecast[:,:,1:], 1E-6)
+        return self.vforecast
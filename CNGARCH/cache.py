@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class EstimationCache:
+    """
+        On-disk cache of estimation results, content-addressed by everything an estimate() depends on: the return
+        series, the model class and specification (Qpers, targetK, ...), the bounds, the optimizer options, the
+        starting theta and the arguments of estimate() (and the inverse-Hessian it warm starts from).
+        Each entry keeps theta, the log-likelihood, the success flag and the inverse-Hessian. Entries beyond maxbytes
+        are evicted least recently used first.
+        The cache is one SQLite file, every process and thread opens its own connection, so the workers of a pool
+        (processes or threads) and several backtests can share it. Set model.cache = EstimationCache(path): a hit in estimate() or parallel() skips the
+        optimizer.
+    """
+    # bumped when the estimation changes, the entries of older versions are never hit again
+    version = 1
+
+    def __init__(self, path:str, maxbytes:int=256*1024*1024) -> None:
+        self.path = path
+        self.maxbytes = maxbytes
+        # one connection per thread, reopened in a new process
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # the connections stay in their process, copies (pool workers) open their own
+        return {'path':self.path, 'maxbytes':self.maxbytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['maxbytes'])
+
+    def _connect(self)->sqlite3.Connection:
+        local = self._local
+        if getattr(local, 'pid', None)!=os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, theta BLOB, '
+                                     'loglikelihood REAL, success INTEGER, hessinv BLOB, size INTEGER, used INTEGER)')
+            local.pid = os.getpid()
+        return local.connection
+
+    def key(self, model, optimizer:str='minimize', nbhopping:int=10, gradient:bool=True, theta=None)->str:
+        # the key of model.estimate(optimizer, nbhopping, gradient) started from theta (model.x by default)
+        theta = model.x if theta is None else theta
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(model.R, dtype=float).tobytes())
+        digest.update(np.ascontiguousarray(theta, dtype=float).tobytes())
+        description = {'version':self.version, 'class':f"{type(model).__module__}.{type(model).__qualname__}",
+                       'specification':model._specification(), 'bounds':model.OptimizationBounds,
+                       'options':model.OptimizationOptions, 'optimizer':optimizer, 'nbhopping':nbhopping,
+                       'gradient':gradient}
+        if optimizer=='warmstart':
+            description['warmoptions'] = model.WarmStartOptions
+            if model._hessinv is not None:
+                digest.update(np.ascontiguousarray(model._hessinv, dtype=float).tobytes())
+        digest.update(json.dumps(description, sort_keys=True, default=repr).encode())
+        return digest.hexdigest()
+
+    def lookup(self, key:str):
+        # (theta, log-likelihood, success, inverse-Hessian or None) of key, None when it is not in the cache
+        connection = self._connect()
+        row = connection.execute('SELECT theta, loglikelihood, success, hessinv FROM results WHERE key=?',
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE results SET used=? WHERE key=?', (time.time_ns(), key))
+        hessinv = None
+        if row[3] is not None:
+            hessinv = np.frombuffer(row[3], dtype=float).copy()
+            n = int(round(np.sqrt(len(hessinv))))
+            hessinv = hessinv.reshape((n, n))
+        return np.frombuffer(row[0], dtype=float).copy(), row[1], bool(row[2]), hessinv
+
+    def store(self, key:str, theta, loglikelihood:float, success:bool, hessinv=None):
+        theta = np.ascontiguousarray(theta, dtype=float).tobytes()
+        hessinv = None if hessinv is None else np.ascontiguousarray(hessinv, dtype=float).tobytes()
+        size = len(key) + len(theta) + (0 if hessinv is None else len(hessinv)) + 32
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, theta, float(loglikelihood), int(success), hessinv, size, time.time_ns()))
+            # least recently used first out, once the entries add up to more than maxbytes
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total>self.maxbytes:
+                kept = 0
+                evicted = []
+                for oldkey, oldsize in connection.execute('SELECT key, size FROM results ORDER BY used DESC'):
+                    kept += oldsize
+                    if kept>self.maxbytes:
+                        evicted.append((oldkey,))
+                connection.executemany('DELETE FROM results WHERE key=?', evicted)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def restore(self, key:str, model)->bool:
+        # put the cached estimate of key in model, False when it is not in the cache
+        found = self.lookup(key)
+        if found is None:
+            return False
+        state = model.to_state()
+        state.theta, state.loglikelihood, state.success, state.hessinv = found
+        model.set_state(state)
+        model.scipyresult = None
+        return True
+
+    def __len__(self)->int:
+        return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def clear(self):
+        self._connect().execute('DELETE FROM results')
+
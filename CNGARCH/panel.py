@@ -0,0 +1,72 @@
+from typing import Union
+import numpy as np
+from .CNGARCH import *
+from .CNGARCH import _estimatestart
+
+
+def panelestimate(model:gmodel, Returns:Union[dict, np.ndarray], thetas:np.ndarray=None, Ncores:int=4, estpool=None)->dict:
+    """
+        Estimate the specification of model (class, Qpers/targetK, bounds and options) on every asset of a panel,
+        from every start in thetas (model's genrandomthetas() starts by default).
+        Returns is a dict {asset: returns} or a 2D array with one asset per column, NaNs (shorter histories) dropped.
+        Every (asset, start) pair is one task of a single run over the pool. The tasks are sent longest series
+        first, one at a time, so the workers stay busy until the last ones.
+        Returns a table (dict of columns, one row per asset, in the order of Returns):
+        asset, theta, loglikelihood, success, time (worker seconds over all the starts), beststart and stats
+        (EstimationStats summed over the starts),
+        plus every start's results in allthetas, allloglikelihoods, allsuccess and alltimes.
+    """
+    if isinstance(Returns, dict):
+        assets = list(Returns.keys())
+        series = [np.asarray(Returns[asset], dtype=float).flatten() for asset in assets]
+    else:
+        Returns = np.asarray(Returns, dtype=float)
+        if Returns.ndim==1:
+            Returns = Returns[:,None]
+        assets = list(range(np.size(Returns,1)))
+        series = [Returns[:,iasset] for iasset in assets]
+    series = [R[~np.isnan(R)] for R in series]
+
+    if thetas is None:
+        thetas = model._multix
+    thetas = np.atleast_2d(thetas)
+    nassets = len(assets)
+    nstarts = np.size(thetas,0)
+
+    ownpool = estpool is None
+    if ownpool:
+        estpool = EstimationPool(Ncores)
+
+    allthetas = np.zeros((nassets, nstarts, np.size(thetas,1)), dtype=float)
+    allloglikelihoods = np.zeros((nassets, nstarts), dtype=float)
+    allsuccess = np.zeros((nassets, nstarts), dtype=bool)
+    alltimes = np.zeros((nassets, nstarts), dtype=float)
+    stats = [EstimationStats() for iasset in range(nassets)]
+    try:
+        tasks = []
+        for iasset in np.argsort([-len(R) for R in series], kind='stable'):
+            name, N = estpool.share(series[iasset])
+            for istart in range(nstarts):
+                tasks.append((iasset, istart, (name, N, model.to_state(thetas[istart,:]))))
+
+        for iasset, istart, output in estpool.imap_unordered(_panelstart, tasks):
+            allthetas[iasset,istart,:] = output[0]
+            allloglikelihoods[iasset,istart] = output[1]
+            allsuccess[iasset,istart] = output[2]
+            alltimes[iasset,istart] = output[3]
+            stats[iasset] = stats[iasset] + output[5]
+    finally:
+        if ownpool:
+            estpool.close()
+
+    beststart = np.array([np.nanargmin(allloglikelihoods[iasset,:]) for iasset in range(nassets)], dtype=int)
+    rows = np.arange(nassets)
+    return {'asset':assets, 'theta':allthetas[rows,beststart,:], 'loglikelihood':allloglikelihoods[rows,beststart],
+            'success':allsuccess[rows,beststart], 'time':np.sum(alltimes, axis=1), 'beststart':beststart,
+            'stats':stats, 'allthetas':allthetas, 'allloglikelihoods':allloglikelihoods, 'allsuccess':allsuccess, 'alltimes':alltimes}
+
+
+def _panelstart(task):
+    # one (asset, start) estimation, tagged so the results can come back in any order
+    iasset, istart, start = task
+    return iasset, istart, _estimatestart(start)
@@ -0,0 +1,200 @@
+"""
+    Throughput benchmarks of the CNGARCH package
+
+    Times filter(), estimate(), parallel() for several numbers of starts, forecast() and backtesting() for every
+    model class, on the bundled hd_QQQ.csv and hd_EGHT.csv and on synthetic series of 1k to 100k days simulated
+    from the cngarch specification. The results are written to a JSON file and compared with a stored baseline,
+    a timing slower than the baseline by more than the tolerance is reported as a regression (exit code 1).
+
+    python benchmarks/benchmark.py                      # full run, compared with benchmarks/baseline.json
+    python benchmarks/benchmark.py --quick              # small series and start counts only
+    python benchmarks/benchmark.py --update-baseline    # store this run as the baseline
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import CNGARCH as cg
+
+SPECS = {
+    'garch':   (cg.garch,   [0.1, 0.012, 0.95, 0.05],
+                ((0,None), (0.001,0.06), (0.5,1), (0.01,0.1)),
+                ((0,0.5), (0.001,0.01), (0.3,0.9), (0.02,0.1))),
+    'ngarch':  (cg.ngarch,  [0.1, 0.012, 0.95, 0.05, 0.5],
+                ((0,None), (0.001,0.06), (0.5,1), (0.01,0.1), (-5,+5)),
+                ((0,0.5), (0.001,0.01), (0.3,0.9), (0.02,0.1), (-5,+5))),
+    'cgarch':  (cg.cgarch,  [0.1, 0.012, 0.8, 0.05, 0.99, 0.02],
+                ((0,None), (0.001,0.06), (0.3,0.99), (0.01,0.1), (0.9,0.99999), (0,0.2)),
+                ((0,0.5), (0.001,0.01), (0.3,0.9), (0.02,0.1), (0.9,0.99999), (0.001,0.05))),
+    'cngarch': (cg.cngarch, [0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1],
+                ((0,None), (0.001,0.06), (0.5,1), (0.01,0.1), (-5,+5), (0.9,0.99999), (0,0.2), (-5,+5)),
+                ((0,0.5), (0.001,0.01), (0.3,0.9), (0.02,0.1), (-5,+5), (0.9,0.99999), (0.001,0.05), (-5,+5))),
+}
+
+# warm-started backtest of the last BACKTEST_NWINDOWS windows of the first series long enough for it
+BACKTEST_WINDOW = 1000
+BACKTEST_NWINDOWS = 50
+
+
+def bundled(name:str)->np.ndarray:
+    prices = np.genfromtxt(os.path.join(os.path.dirname(HERE), f"hd_{name}.csv"), delimiter=',', skip_header=1, usecols=(2,))
+    return np.diff(np.log(prices))
+
+
+def synthetic(ndays:int, seed:int=1)->np.ndarray:
+    # one path of the cngarch specification started from the last QQQ day
+    model = cg.cngarch(np.array([0.05, 0.012, 0.65, 0.05, 0.8, 0.995, 0.02, 0.5]), bundled('QQQ'))
+    returns, variances, components = model.simulate(1, ndays, seed=seed)
+    return returns[0,:]
+
+
+def besttime(func, repeat:int)->float:
+    # best of repeat calls, after one call to compile or load the kernels and fill the caches
+    func()
+    best = np.inf
+    for irepeat in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def newmodel(spec:str, R:np.ndarray):
+    cls, x, bounds, thetarange = SPECS[spec]
+    model = cls(np.array(x), R)
+    model.OptimizationBounds = bounds
+    return model
+
+
+def warmup(spec:str, R:np.ndarray, pool, ncores:int):
+    # scipy import, kernels loaded from the cache in this process and in every worker, outside of the timings
+    newmodel(spec, R).estimate()
+    model = newmodel(spec, R)
+    model.parallel(model.genrandomthetas(SPECS[spec][3], n=2*ncores, seed=0), estpool=pool)
+
+
+def benchmarkseries(spec:str, dataname:str, R:np.ndarray, starts:list, pool, results:dict, backtest:bool, repeat:int):
+    key = f"{spec}/{dataname}"
+    N = len(R)
+    model = newmodel(spec, R)
+
+    seconds = besttime(model.filter, repeat=5*repeat)
+    results[f"{key}/filter"] = {'seconds':seconds, 'us_per_day':1E6*seconds/N}
+
+    model.filter()
+    seconds = besttime(lambda: model.forecast(250), repeat=20*repeat)
+    results[f"{key}/forecast250"] = {'seconds':seconds}
+
+    # the estimations start from a new model every time, the last one is kept for the statistics
+    last = {}
+    def estimate():
+        last['model'] = newmodel(spec, R)
+        last['model'].estimate()
+    seconds = besttime(estimate, repeat=repeat)
+    model = last['model']
+    results[f"{key}/estimate"] = {'seconds':seconds, 'nfev':int(model.scipyresult.nfev),
+                                  'loglikelihood':float(model.loglikelihood), 'success':bool(model.success)}
+
+    for nstarts in starts:
+        thetas = newmodel(spec, R).genrandomthetas(SPECS[spec][3], n=nstarts, seed=1)
+        def parallel():
+            last['model'] = newmodel(spec, R)
+            last['model'].parallel(thetas, estpool=pool)
+        seconds = besttime(parallel, repeat=repeat)
+        results[f"{key}/parallel{nstarts}"] = {'seconds':seconds, 'loglikelihood':float(last['model'].loglikelihood)}
+
+    if backtest:
+        Rb = R[-(BACKTEST_WINDOW + BACKTEST_NWINDOWS + 22 - 1):]
+        horizons = np.array([1, 5, 22])
+        Real = np.ones((BACKTEST_NWINDOWS, len(horizons)))*1E-4
+        def backtesting():
+            cg.backtesting(newmodel(spec, Rb), Rb, Real, estimatewindowsize=BACKTEST_WINDOW,
+                           estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+        results[f"{key}/backtest{BACKTEST_NWINDOWS}"] = {'seconds':besttime(backtesting, repeat=repeat)}
+
+
+def compare(results:dict, baseline:dict, tolerance:float, floor:float)->list:
+    # (name, baseline seconds, seconds, ratio) of every timing slower than the baseline by more than tolerance,
+    # timings under floor seconds in both runs are timer noise and never reported
+    regressions = []
+    for name, value in results.items():
+        if name in baseline:
+            ratio = value['seconds']/baseline[name]['seconds']
+            print(f"{name:40s} {baseline[name]['seconds']:10.5f} {value['seconds']:10.5f} {ratio:7.2f}")
+            if ratio>1 + tolerance and value['seconds']>=floor:
+                regressions.append((name, baseline[name]['seconds'], value['seconds'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CNGARCH throughput benchmarks')
+    parser.add_argument('--output', default=os.path.join(HERE, 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--floor', type=float, default=1E-3, help='timings faster than this are not compared')
+    parser.add_argument('--cores', type=int, default=4)
+    parser.add_argument('--backend', default='process', choices=['process', 'thread'],
+                        help='pool of parallel(): spawned processes or threads sharing the series')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs of every timing')
+    parser.add_argument('--models', nargs='+', default=list(SPECS.keys()), choices=list(SPECS.keys()))
+    parser.add_argument('--quick', action='store_true', help='1k and 10k synthetic days, 1 and 4 starts')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline file')
+    args = parser.parse_args()
+
+    if args.quick:
+        datasets = {'synthetic1k':synthetic(1000), 'synthetic10k':synthetic(10000)}
+        starts = [1, 4]
+    else:
+        datasets = {'QQQ':bundled('QQQ'), 'EGHT':bundled('EGHT'), 'synthetic1k':synthetic(1000),
+                    'synthetic10k':synthetic(10000), 'synthetic100k':synthetic(100000)}
+        starts = [1, 4, 16]
+
+    import numba, scipy
+    output = {'meta':{'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'python':platform.python_version(),
+                      'numpy':np.__version__, 'scipy':scipy.__version__, 'numba':numba.__version__,
+                      'machine':platform.machine(), 'processor':platform.processor(), 'cpus':os.cpu_count(),
+                      'cores':args.cores, 'backend':args.backend, 'repeat':args.repeat, 'quick':args.quick},
+              'results':{}}
+
+    backtestdata = [dataname for dataname, R in datasets.items() if len(R)>=BACKTEST_WINDOW + BACKTEST_NWINDOWS + 21][0]
+    pooltype = cg.EstimationThreadPool if args.backend=='thread' else cg.EstimationPool
+    with pooltype(args.cores) as pool:
+        for spec in args.models:
+            warmup(spec, datasets[backtestdata][:500], pool, args.cores)
+            for dataname, R in datasets.items():
+                print(f"{spec} {dataname} ({len(R)} days)", flush=True)
+                benchmarkseries(spec, dataname, R, starts, pool, output['results'],
+                                backtest=dataname==backtestdata, repeat=args.repeat)
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1)
+    print(f"results written to {args.output}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=1)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --update-baseline to store one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f"{'':40s} {'baseline':>10s} {'now':>10s} {'ratio':>7s}")
+    regressions = compare(output['results'], baseline['results'], args.tolerance, args.floor)
+    for name, before, now, ratio in regressions:
+        print(f"REGRESSION {name}: {before:.5f}s -> {now:.5f}s ({ratio:.2f}x)")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
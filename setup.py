@@ -2,7 +2,7 @@ import setuptools
 
 setuptools.setup(name='cngarch',
 version='2.1.6',
-description='Estimate and Forecast using Component NGARCH models, uses sklearn metrics in backtesting',
+description='Estimate and Forecast using Component NGARCH models',
 url='#',
 author='max',
 author_email='letournp@uww.edu',
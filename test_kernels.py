@@ -0,0 +1,789 @@
+import multiprocessing as mp
+import pickle
+import subprocess
+import sys
+import numpy as np
+import pytest
+import CNGARCH as cg
+
+
+def _returns(n=2520):
+    prices = np.genfromtxt("./hd_QQQ.csv", delimiter=',', skip_header=1, usecols=(2,))
+    return np.diff(np.log(prices))[-n:]
+
+
+SPECS = [
+    (cg.garch,   [0.1, 0.012, 0.95, 0.05], {},
+        ((0,0.5), (0.005,0.02), (0.8,0.99), (0.01,0.1))),
+    (cg.ngarch,  [0.1, 0.012, 0.95, 0.05, 0.5], {},
+        ((0,0.5), (0.005,0.02), (0.8,0.99), (0.01,0.1), (-1,1))),
+    (cg.cgarch,  [0.1, 0.012, 0.8, 0.05, 0.99, 0.02], {},
+        ((0,0.5), (0.005,0.02), (0.5,0.9), (0.01,0.1), (0.9,0.999), (0.001,0.05))),
+    (cg.cgarch,  [0.1, 0.012, 0.8, 0.05, 0.02], {'Qpers':True},
+        ((0,0.5), (0.005,0.02), (0.5,0.9), (0.01,0.1), (0.001,0.05))),
+    (cg.cngarch, [0.1, 0.012, 0.65, 0.05, 0.8, 0.995, 0.02, 0.5], {},
+        ((0,0.5), (0.005,0.02), (0.3,0.9), (0.02,0.1), (-5,5), (0.9,0.99999), (0.001,0.05), (-5,5))),
+    (cg.cngarch, [0.1, 0.012, 0.65, 0.05, 0.8, 0.02, 0.5], {'Qpers':True},
+        ((0,0.5), (0.005,0.02), (0.3,0.9), (0.02,0.1), (-5,5), (0.001,0.05), (-5,5))),
+]
+
+# the generic K-component model, shortest component first
+KSPECS = [
+    (cg.kngarch, [0.1, 0.012, 0.5, 0.05, 0.8, 0.9, 0.03, 0.4, 0.995, 0.02, 0.5], {'K':3},
+        ((0,0.5), (0.005,0.02), (0.3,0.7), (0.02,0.1), (-1,1), (0.8,0.95), (0.01,0.05), (-1,1),
+         (0.98,0.999), (0.001,0.03), (-1,1))),
+    (cg.kngarch, [0.1, 0.012, 0.5, 0.05, 0.9, 0.03, 0.995, 0.02], {'K':3, 'asymmetric':False},
+        ((0,0.5), (0.005,0.02), (0.3,0.7), (0.02,0.1), (0.8,0.95), (0.01,0.05), (0.98,0.999), (0.001,0.03))),
+]
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS + KSPECS)
+def test_screenthetas_matches_filter(cls, x, kwargs, thetarange):
+    model = cls(np.array(x), _returns(), **kwargs)
+    thetas = model.genrandomthetas(thetarange, n=200, seed=3)
+    scores = model.screenthetas(thetas)
+
+    expected = np.zeros_like(scores)
+    for iest in range(len(thetas)):
+        model.set_theta(thetas[iest,:])
+        expected[iest] = model.filter(output="estimate")
+
+    valid = np.isfinite(scores)
+    assert valid.sum() > 0
+    np.testing.assert_array_equal(scores[valid], expected[valid])
+    # rejected starts are the ones that break the constraints
+    for iest in np.flatnonzero(~valid):
+        model.set_theta(thetas[iest,:])
+        assert model._penalty_constraints() > 0
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS + KSPECS)
+def test_gradient_matches_finite_differences(cls, x, kwargs, thetarange):
+    x = np.array(x)
+    model = cls(x.copy(), _returns(), **kwargs)
+    LL, grad = model.filter(output="gradient")
+    assert LL == model.filter(output="estimate")
+
+    numerical = np.zeros_like(x)
+    for idx in range(len(x)):
+        h = 1e-6*max(1.0, abs(x[idx]))
+        up, down = x.copy(), x.copy()
+        up[idx] += h
+        down[idx] -= h
+        model.set_theta(up)
+        fup = model.filter(output="estimate")
+        model.set_theta(down)
+        fdown = model.filter(output="estimate")
+        numerical[idx] = (fup - fdown) / (2*h)
+
+    np.testing.assert_allclose(grad, numerical, rtol=1e-5, atol=1e-3)
+
+
+def test_gradient_estimate_matches_finite_differences():
+    x = [0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1]
+    bounds = ((0,None), (0.001,0.06), (0.5,1), (0.01,0.1), (-5,+5), (0.9,0.99999), (0,0.2), (-5,+5))
+    results = {}
+    for gradient in (True, False):
+        model = cg.cngarch(np.array(x), _returns())
+        model.OptimizationBounds = bounds
+        model.estimate(gradient=gradient)
+        assert model.success
+        results[gradient] = model.scipyresult
+    assert results[True].fun <= results[False].fun + 1e-6
+    assert results[True].nfev < results[False].nfev
+
+
+# targeted specifications: x without sigma (targetV) and without alpha_1 (targetK)
+TARGETSPECS = [
+    (cg.garch,   [0.1, 0.95], {'targetV':True, 'targetK':True}),
+    (cg.ngarch,  [0.1, 0.012, 0.95, 0.5], {'targetK':6.0}),
+    (cg.cgarch,  [0.1, 0.8, 0.99, 0.02], {'targetV':True, 'targetK':True}),
+    (cg.cngarch, [0.1, 0.65, 0.05, 0.8, 0.995, 0.02, 0.5], {'targetV':True}),
+    (cg.cngarch, [0.1, 0.65, 0.8, 0.02, 0.5], {'Qpers':True, 'targetV':True, 'targetK':True}),
+    (cg.kngarch, [0.1, 0.5, 0.8, 0.9, 0.03, 0.4, 0.995, 0.02, 0.5], {'K':3, 'targetV':True, 'targetK':True}),
+]
+
+
+@pytest.mark.parametrize("cls,x,kwargs", TARGETSPECS)
+def test_targeted_gradient_matches_finite_differences(cls, x, kwargs):
+    from CNGARCH.CNGARCH import _kurtosisterms
+    x = np.array(x)
+    R = _returns()
+    model = cls(x.copy(), R, **kwargs)
+    natural = model._kernelnatural()
+    centred = R - R.mean()
+    if kwargs.get('targetV'):
+        np.testing.assert_allclose(natural[1], centred.std(), rtol=1e-12)
+    if kwargs.get('targetK'):
+        target = np.mean(centred**4)/np.mean(centred**2)**2 if kwargs['targetK'] is True else kwargs['targetK']
+        A, B, C = _kurtosisterms(natural)
+        np.testing.assert_allclose(3/(1 - A*natural[3]**2 - B*natural[3] - C), target, rtol=1e-10)
+
+    LL, grad = model.filter(output="gradient")
+    assert len(grad) == len(x)
+    numerical = np.zeros_like(x)
+    for idx in range(len(x)):
+        h = 1e-6*max(1.0, abs(x[idx]))
+        up, down = x.copy(), x.copy()
+        up[idx] += h
+        down[idx] -= h
+        model.set_theta(up)
+        fup = model.filter(output="estimate")
+        model.set_theta(down)
+        fdown = model.filter(output="estimate")
+        numerical[idx] = (fup - fdown) / (2*h)
+    np.testing.assert_allclose(grad, numerical, rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize("cls,x,kwargs", [spec[:3] for spec in SPECS + KSPECS] + TARGETSPECS)
+def test_scores_sum_to_the_gradient(cls, x, kwargs):
+    R = _returns()
+    model = cls(np.array(x), R, **kwargs)
+    LL, grad = model.filter(output="gradient")
+    scores = model.scores()
+    assert scores.shape == (len(R), len(x))
+    np.testing.assert_allclose(scores.sum(axis=0), -grad, rtol=1e-10, atol=1e-10)
+    if not kwargs.get('targetV') and not kwargs.get('targetK'):
+        # the first days of the series are the scores of the shorter series
+        short = cls(np.array(x), R[:1000], **kwargs)
+        np.testing.assert_allclose(scores[:1000,:].sum(axis=0), -short.filter(output="gradient")[1], rtol=1e-10, atol=1e-10)
+
+
+def test_standard_errors_opg_matches_qml_on_the_model():
+    # on returns simulated from the model the information matrix equality holds, both estimates agree
+    x = np.array([0.05, 0.012, 0.65, 0.05, 0.8, 0.995, 0.02, 0.5])
+    returns = cg.cngarch(x, _returns()).simulate(1, 5000, seed=2)[0]
+    model = cg.cngarch(x.copy(), returns[0,:])
+    model.estimate()
+    assert model.success
+    opg = model.standarderrors('opg')
+    qml = model.standarderrors('qml')
+    assert np.all(opg > 0)
+    np.testing.assert_allclose(qml, opg, rtol=0.2)
+    np.testing.assert_allclose(model.covariance('opg'), np.linalg.inv(model.scores().T @ model.scores()))
+    with pytest.raises(Exception):
+        model.covariance('hessian')
+
+
+def test_kurtosis_matches_simulation():
+    from CNGARCH.CNGARCH import _kurtosisterms
+    model = cg.cngarch(np.array([0.0, 0.012, 0.6, 0.08, 0.5, 0.97, 0.03, 0.3]), _returns())
+    A, B, C = _kurtosisterms(model._natural())
+    returns, variances, components = model.simulate(10, 100000, seed=3)
+    variances = variances[:,5000:]
+    np.testing.assert_allclose(np.mean(variances**2)/np.mean(variances)**2, 1/(1 - A*0.08**2 - B*0.08 - C), rtol=2e-3)
+
+
+def test_targeted_estimate_runs_on_the_reduced_vector():
+    R = _returns()
+    model = cg.cngarch(np.array([0.1, 0.65, 0.8, 0.995, 0.02, 0.5]), R[:2000], targetV=True, targetK=True)
+    model.OptimizationBounds = ((0,0.5), (0.3,0.99), (-5,5), (0.9,0.99999), (0.001,0.2), (-5,5))
+    model.estimate()
+    assert model.success and len(model.x) == 6
+    assert model._penalty_constraints() == 0
+    # the targets follow R
+    model.R = R[500:]
+    np.testing.assert_allclose(model._natural()[1], (R[500:] - R[500:].mean()).std(), rtol=1e-12)
+    assert model.glabel == 'C-NGARCH(1,1)-VT-KTE-True'
+
+
+def test_unbounded_estimate_respects_constraints():
+    # without OptimizationBounds only the constraint penalty keeps sigma>0 and persistence<1
+    model = cg.cngarch(np.array([0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1]), _returns(500))
+    model.estimate()
+    assert model._penalty_constraints() == 0
+
+
+def test_estimation_stats():
+    model = cg.cngarch(np.array([0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1]), _returns(500))
+    model.estimate()
+    stats = model.stats
+    assert stats.nestimates == 1
+    assert stats.nfev == model.scipyresult.nfev
+    assert stats.nit == model.scipyresult.nit
+    # the unbounded optimizer is only kept inside the constraints by the penalty
+    assert stats.constrainthits > 0
+    assert 0 < stats.kerneltime < stats.totaltime
+    assert stats.overhead == stats.totaltime - stats.kerneltime
+    total = sum([stats, stats], cg.EstimationStats())
+    assert total.nfev == 2*stats.nfev and total.nestimates == 2
+
+
+def test_warmstart_matches_full_reestimation():
+    R = _returns(2040)
+    x = [0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1]
+    bounds = ((0,None), (0.001,0.06), (0.5,1), (0.01,0.1), (-5,+5), (0.9,0.99999), (0,0.2), (-5,+5))
+    model = cg.cngarch(np.array(x), R[:2000])
+    model.OptimizationBounds = bounds
+    model.estimate()
+    warmcalls, fullcalls = 0, 0
+    for index in range(1, 6):
+        model.R = R[index:2000+index]
+        full = cg.cngarch(np.array(model.x), model.R)
+        full.OptimizationBounds = bounds
+        full.estimate()
+        model.estimate(optimizer='warmstart')
+        assert model.success
+        assert model.loglikelihood <= full.loglikelihood + 1e-2
+        warmcalls += model.scipyresult.nfev
+        fullcalls += full.scipyresult.nfev
+    # the warm start is only worth it if it needs fewer objective calls than a cold estimate from the same point
+    assert warmcalls < fullcalls
+
+
+def test_realizedtargets_match_loops():
+    R = _returns(400)
+    horizons = np.array([1, 5, 22])
+    total = cg.realizedtargets(R, 300, horizons)
+    peak = cg.realizedtargets(R, 300, horizons, cg.PEAKDREALIZEDVARIANCE)
+    nwindows = len(R) - 300 - 22 + 1
+    assert total.shape == peak.shape == (nwindows, 3)
+    for index in range(nwindows):
+        for ih, ihor in enumerate(horizons):
+            days = R[300+index:300+index+ihor]
+            np.testing.assert_allclose(total[index,ih], np.sum(days**2), rtol=1e-9)
+            assert peak[index,ih] == np.max(days**2)
+    # one asset per column
+    panel = cg.realizedtargets(np.c_[R, 2*R], 300, horizons, cg.PEAKDREALIZEDVARIANCE)
+    np.testing.assert_array_equal(panel[:,:,0], peak)
+    np.testing.assert_array_equal(panel[:,:,1], 4*peak)
+
+
+def test_forecastmetrics_match_sklearn():
+    metrics = pytest.importorskip('sklearn.metrics')
+    rng = np.random.default_rng(0)
+    real = np.exp(rng.normal(-9, 0.5, (200, 3)))
+    forecast = real*np.exp(rng.normal(0, 0.3, (200, 3)))
+    accumulator = cg.ForecastMetrics([1, 5, 22])
+    for index in range(200):
+        accumulator.update(real[index,:], forecast[index,:])
+    results = accumulator.results()
+    for index, ihor in enumerate([1, 5, 22]):
+        y, f = real[:,index], forecast[:,index]
+        np.testing.assert_allclose(results[ihor]['Rsquare'], metrics.r2_score(y, f), rtol=1e-10)
+        np.testing.assert_allclose(results[ihor]['RMSE'], np.sqrt(metrics.mean_squared_error(y, f)), rtol=1e-10)
+        np.testing.assert_allclose(results[ihor]['evs'], metrics.explained_variance_score(y, f), rtol=1e-10)
+        np.testing.assert_allclose(results[ihor]['mae'], metrics.mean_absolute_error(y, f), rtol=1e-10)
+        np.testing.assert_allclose(results[ihor]['mape'], metrics.mean_absolute_percentage_error(y, f), rtol=1e-10)
+        np.testing.assert_allclose(results[ihor]['qlike'], np.mean(y/f - np.log(y/f) - 1), rtol=1e-10)
+        assert results[ihor]['n'] == 200
+
+    # batches of windows merge into the same moments
+    batched = cg.ForecastMetrics([1, 5, 22])
+    batched.update(real[:1,:], forecast[:1,:])
+    batched.update(real[1:120,:], forecast[1:120,:])
+    batched.update(real[120,:], forecast[120,:])
+    batched.update(real[121:,:], forecast[121:,:])
+    for ihor, values in batched.results().items():
+        for name, value in values.items():
+            np.testing.assert_allclose(value, results[ihor][name], rtol=1e-10)
+
+
+def test_backtesting_warm_start():
+    R = _returns(330)
+    horizons = np.array([1, 5])
+    nwindows = len(R) - 300 - 5 + 1
+    Real = np.ones((nwindows, len(horizons)))*1e-4
+    model = cg.garch(np.array([0.1, 0.012, 0.95, 0.05]))
+    output = cg.backtesting(model, R, Real, estimatewindowsize=300, estimatemethod=cg.ESTIMATE_METHOD_WARM_START,
+                            forecasthorizon=horizons)
+    assert output[5]['model']['forecast'].shape == (nwindows,)
+    assert np.all(output[5]['model']['forecast'] > output[1]['model']['forecast'])
+    # the first window and every warm-started one
+    assert output['stats'].nestimates == nwindows + 1
+    live = cg.ForecastMetrics(horizons)
+    cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                   estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons, metrics=live)
+    assert live.n == nwindows
+    assert live.results()[5]['qlike'] == output[5]['model']['qlike']
+    # the targets default to the realized variance of the returns
+    built = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, estimatewindowsize=300,
+                           estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+    explicit = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, cg.realizedtargets(R, 300, horizons),
+                              estimatewindowsize=300, estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+    assert built[5]['model']['RMSE'] == explicit[5]['model']['RMSE']
+
+
+def test_backtesting_warm_start_with_pool():
+    R = _returns(330)
+    horizons = np.array([1, 5])
+    nwindows = len(R) - 300 - 5 + 1
+    Real = np.ones((nwindows, len(horizons)))*1e-4
+    serial = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                            estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+    # spawned workers: forking after the numba thread pool is up can deadlock
+    with mp.get_context('spawn').Pool(2) as estpool:
+        pooled = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                                estimatemethod=cg.ESTIMATE_METHOD_WARM_START, estpool=estpool, forecasthorizon=horizons)
+    np.testing.assert_allclose(pooled[5]['model']['forecast'], serial[5]['model']['forecast'])
+
+
+def test_backtesting_store_resumes(tmp_path):
+    R = _returns(330)
+    horizons = np.array([1, 5])
+    nwindows = len(R) - 300 - 5 + 1
+    Real = np.ones((nwindows, len(horizons)))*1e-4
+    run = lambda store: cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                                       estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons, store=store)
+    full = run(None)
+    stored = run(str(tmp_path/'run'))
+    np.testing.assert_array_equal(stored[5]['model']['forecast'], full[5]['model']['forecast'])
+
+    # a run that died after 10 windows resumes from the 10th and ends with the same results
+    store = cg.BacktestStore(str(tmp_path/'run'), 'r+')
+    assert store.completed == nwindows
+    np.testing.assert_array_equal(store.forecast[:,1], full[5]['model']['forecast'])
+    theta = np.array(store.theta)
+    store.done[10:] = False
+    store.forecast[10:,:] = 0
+    del store
+    resumed = run(str(tmp_path/'run'))
+    assert resumed['stats'].nestimates == nwindows - 10
+    np.testing.assert_array_equal(resumed[5]['model']['forecast'], full[5]['model']['forecast'])
+    assert resumed[5]['model']['qlike'] == full[5]['model']['qlike']
+    store = cg.BacktestStore(str(tmp_path/'run'))
+    np.testing.assert_array_equal(store.theta, theta)
+
+    # another configuration is refused
+    with pytest.raises(Exception):
+        cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=301,
+                       estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons, store=str(tmp_path/'run'))
+
+
+def test_backtesting_parallel_windows_matches_serial():
+    R = _returns(340)
+    horizons = np.array([1, 5])
+    nwindows = len(R) - 300 - 5 + 1
+    Real = np.ones((nwindows, len(horizons)))*1e-4
+    serial = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                            estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+    chunked = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, Real, estimatewindowsize=300,
+                             estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons,
+                             Ncores=2, parallelwindows=True)
+    for ihor in horizons:
+        np.testing.assert_allclose(chunked[ihor]['model']['forecast'], serial[ihor]['model']['forecast'], rtol=1e-3)
+
+
+def test_backtesting_parallel_windows_refuses_parallel_all():
+    R = _returns(340)
+    with pytest.raises(Exception):
+        cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, np.ones((36, 1)), estimatewindowsize=300,
+                       estimatemethod=cg.ESTIMATE_METHOD_PARALLEL_ALL, parallelwindows=True)
+
+
+
+def test_backtesting_forecasts_from_the_estimate():
+    # windows 3 and 5 end with a failed estimate, whose paths were left at the optimizer's last trial point
+    R = _returns(560)[:510]
+    x = [0.1, 0.02, 0.65, 0.01, 0.1, 0.995, 0.01, 0.1]
+    horizons = np.array([1, 5])
+    Real = np.ones((6, len(horizons)))*1e-4
+    output = cg.backtesting(cg.cngarch(np.array(x)), R, Real, estimatewindowsize=500,
+                            estimatemethod=cg.ESTIMATE_METHOD_ONE_THETA, forecasthorizon=horizons)
+
+    model = cg.cngarch(np.array(x))
+    for index in range(6):
+        model.R = R[index:500+index]
+        model.estimate()
+        model.filter()
+        point, cumulative = model.termstructure(horizons)
+        assert output[1]['model']['forecast'][index] == cumulative[0]
+        assert output[5]['model']['forecast'][index] == cumulative[1]
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS[::2] + KSPECS[:1])
+def test_backtesting_fixed_matches_refiltered_windows(cls, x, kwargs, thetarange):
+    # a growing window held at theta refilters the same history, the one pass gives the same forecasts
+    R = _returns(700)
+    horizons = np.array([1, 5, 22])
+    output = cg.backtesting(cls(np.array(x), **kwargs), R, estimatewindowsize=500, windowtype=cg.WINDOW_TYPE_GROWING,
+                            estimatemethod=cg.ESTIMATE_METHOD_FIXED, forecasthorizon=horizons)
+    assert output['stats'].nestimates == 0
+
+    model = cls(np.array(x), **kwargs)
+    metrics = cg.ForecastMetrics(horizons)
+    Real = cg.realizedtargets(R, 500, horizons)
+    for index in range(len(R) - 500 - 22 + 1):
+        model.R = R[:500+index]
+        model.filter()
+        point, cumulative = model.termstructure(horizons)
+        metrics.update(Real[index,:], cumulative)
+        for ihor, forecast in zip(horizons, cumulative):
+            assert output[ihor]['model']['forecast'][index] == forecast
+    assert output[22]['model']['RMSE'] == pytest.approx(metrics.results()[22]['RMSE'], rel=1e-12)
+
+    with pytest.raises(Exception):
+        cg.backtesting(cls(np.array(x), **kwargs), R, estimatewindowsize=500, estimatemethod=cg.ESTIMATE_METHOD_FIXED,
+                       parallelwindows=True)
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS + KSPECS)
+def test_update_matches_filter(cls, x, kwargs, thetarange):
+    R = _returns()
+    full = cls(np.array(x), R, **kwargs)
+    full.filter()
+
+    model = cls(np.array(x), R[:-20], **kwargs)
+    model.filter()
+    model.update(R[-20:-5])
+    for day in R[-5:]:
+        model.update(day)
+    np.testing.assert_array_equal(model.R, R)
+    for path, fullpath in zip(model._componentpaths(), full._componentpaths()):
+        np.testing.assert_allclose(path, fullpath, rtol=1e-12)
+    np.testing.assert_allclose(model.loglikelihood, full.loglikelihood, rtol=1e-10)
+
+
+def _recursiveforecast(model, v, q, kdays):
+    # the step by step forecast recursion
+    natural = model._natural()
+    var, p1, p2 = natural[1]**2, natural[2], natural[5]
+    vforecast = np.zeros((kdays+1,))
+    vforecast[0] = v
+    for t in range(1, kdays+1):
+        q = var + p2*(q - var)
+        vforecast[t] = q + p1*(vforecast[t-1] - q)
+    return vforecast
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS)
+def test_termstructure_matches_recursion(cls, x, kwargs, thetarange):
+    model = cls(np.array(x), _returns(), **kwargs)
+    model.filter()
+    horizons = np.array([0, 1, 5, 22, 250])
+    qpath = model.qpath if model._components==2 else np.ones_like(model.vpath)*model._sg**2
+    point, cumulative = model.termstructure(horizons, model.vpath[-300:], qpath[-300:])
+    assert point.shape == cumulative.shape == (300, len(horizons))
+    for index in [0, 150, 299]:
+        expected = _recursiveforecast(model, model.vpath[index-300], qpath[index-300], 250)
+        np.testing.assert_allclose(point[index,:], expected[horizons], rtol=1e-10)
+        np.testing.assert_allclose(cumulative[index,:], [np.sum(expected[:h]) for h in horizons], rtol=1e-10)
+
+    model.forecast(250)
+    np.testing.assert_allclose(model.vforecast, _recursiveforecast(model, model.vpath[-1], qpath[-1], 250), rtol=1e-10)
+
+
+def test_termstructure_equal_persistences():
+    model = cg.cgarch(np.array([0.1, 0.012, 0.95, 0.05, 0.95, 0.02]), _returns())
+    model.filter()
+    point, cumulative = model.termstructure(np.arange(30))
+    expected = _recursiveforecast(model, model.vpath[-1], model.qpath[-1], 29)
+    np.testing.assert_allclose(point, expected, rtol=1e-10)
+    np.testing.assert_allclose(cumulative, np.cumsum(np.r_[0, expected[:-1]]), rtol=1e-10)
+
+
+def test_estimationpool_matches_serial_starts():
+    R = _returns(1000)
+    model = cg.cngarch(np.array([0.1, 0.012, 0.65, 0.05, 0.8, 0.02, 0.5]), R, Qpers=True)
+    thetas = model.genrandomthetas(SPECS[5][3], n=3, seed=3)
+    with cg.EstimationPool(2) as pool:
+        thetaout, best, worked, timers, hessinvs, stats = pool.estimate(model, thetas)
+        # the series is shared once and reused
+        assert pool.share(model.R) == pool.share(R.copy())
+        assert len(pool._shared) == 1
+        model.parallel(estpool=pool)
+
+    for iest in range(len(thetas)):
+        serial = cg.cngarch(thetas[iest,:].copy(), R, Qpers=True)
+        serial.estimate()
+        np.testing.assert_array_equal(thetaout[iest,:], serial.x)
+        assert best[iest] == serial.loglikelihood
+        assert worked[iest] == serial.success
+        np.testing.assert_array_equal(hessinvs[iest], serial._hessinv)
+        assert stats[iest].nfev == serial.stats.nfev
+    np.testing.assert_array_equal(model.x, thetaout[np.nanargmin(best),:])
+    assert model.stats.nestimates == len(thetas)
+    assert model.stats.nfev == sum(stats[iest].nfev for iest in range(len(thetas)))
+
+
+def test_estimationpool_race_stops_early():
+    R = _returns(1000)
+    model = cg.cngarch(np.array([0.1, 0.012, 0.65, 0.05, 0.8, 0.02, 0.5]), R, Qpers=True)
+    thetas = model.genrandomthetas(SPECS[5][3], n=8, seed=3)
+    with cg.EstimationPool(2) as pool:
+        finished, thetaout, best, worked, timers, hessinvs, stats = pool.race(model, thetas, agree=2, tolerance=1e-3)
+        assert 2 <= len(finished) <= len(thetas)
+        # the race only stops before the last start on two agreeing optima
+        lls = best[np.array(worked)]
+        assert len(finished) == len(thetas) or np.sum(lls <= lls.min() + 1e-3) >= 2
+        finished, thetaout, best, worked = pool.race(model, thetas, agree=1)[:4]
+        assert len(finished) < len(thetas) and any(worked)
+        # every finished start is the serial estimate of its theta
+        serial = cg.cngarch(thetas[finished[0],:].copy(), R, Qpers=True)
+        serial.estimate()
+        np.testing.assert_array_equal(thetaout[0,:], serial.x)
+
+        # nothing finishes before a deadline of 0: theta is kept
+        x = model.x.copy()
+        with pytest.warns(UserWarning, match='deadline'):
+            model.parallel(thetas, estpool=pool, deadline=0.0)
+        assert not model.success
+        np.testing.assert_array_equal(model.x, x)
+
+        # the skipped starts leave the pool usable
+        model.parallel(thetas[:2,:], estpool=pool, agree=2)
+        assert model.stats.nestimates == 2
+        full, fullbest = pool.estimate(model, thetas[:2,:])[:2]
+        np.testing.assert_array_equal(model.x, full[np.nanargmin(fullbest),:])
+
+
+def test_estimationthreadpool_matches_serial_starts():
+    from CNGARCH.CNGARCH import _numbafilter, _numbaloglikelihood, _numbascore, _numbascorecngarch
+    for kernel in [_numbafilter, _numbaloglikelihood, _numbascore, _numbascorecngarch]:
+        assert kernel.targetoptions['nogil']
+    R = _returns(1000)
+    model = cg.cngarch(np.array([0.1, 0.012, 0.65, 0.05, 0.8, 0.02, 0.5]), R, Qpers=True)
+    thetas = model.genrandomthetas(SPECS[5][3], n=3, seed=3)
+    with cg.EstimationThreadPool(2) as pool:
+        thetaout, best, worked, timers, hessinvs, stats = pool.estimate(model, thetas)
+        finished, raced = pool.race(model, thetas, agree=1)[:2]
+        assert 1 <= len(finished) <= len(thetas)
+    for iest in range(len(thetas)):
+        serial = cg.cngarch(thetas[iest,:].copy(), R, Qpers=True)
+        serial.estimate()
+        np.testing.assert_array_equal(thetaout[iest,:], serial.x)
+        assert best[iest] == serial.loglikelihood
+        np.testing.assert_array_equal(hessinvs[iest], serial._hessinv)
+        assert stats[iest].nfev == serial.stats.nfev
+    np.testing.assert_array_equal(raced, thetaout[finished,:])
+
+    model.parallel(thetas, Ncores=2, backend='thread')
+    np.testing.assert_array_equal(model.x, thetaout[np.nanargmin(best),:])
+    assert model.stats.nestimates == len(thetas)
+    with pytest.raises(Exception):
+        model.parallel(thetas, backend='fiber')
+
+    R = _returns(340)
+    horizons = np.array([1, 5])
+    serial = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, estimatewindowsize=300,
+                            estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons)
+    threaded = cg.backtesting(cg.garch(np.array([0.1, 0.012, 0.95, 0.05])), R, estimatewindowsize=300,
+                              estimatemethod=cg.ESTIMATE_METHOD_WARM_START, forecasthorizon=horizons,
+                              Ncores=2, parallelwindows=True, backend='thread')
+    for ihor in horizons:
+        np.testing.assert_allclose(threaded[ihor]['model']['forecast'], serial[ihor]['model']['forecast'], rtol=1e-3)
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS + KSPECS)
+def test_model_state_roundtrip(cls, x, kwargs, thetarange):
+    R = _returns(800)
+    model = cls(np.array(x), R, **kwargs)
+    model.OptimizationBounds = thetarange
+    model.estimate()
+    model.filter()
+    model.forecast(22)
+
+    state = pickle.loads(pickle.dumps(model.to_state()))
+    # no series, paths or optimizer result: a few hundred bytes instead of the whole model
+    assert len(pickle.dumps(model.to_state(x))) < 1000 < len(pickle.dumps(model))
+    rebuilt = cg.gmodel.from_state(state, R)
+    assert type(rebuilt) is cls and rebuilt._specification() == model._specification()
+    np.testing.assert_array_equal(rebuilt.x, model.x)
+    np.testing.assert_array_equal(rebuilt._hessinv, model._hessinv)
+    assert rebuilt.OptimizationBounds == model.OptimizationBounds
+    assert rebuilt.loglikelihood == model.loglikelihood and rebuilt.success == model.success
+    assert rebuilt.filter() == model.filter()
+
+    start = model.to_state(np.array(x))
+    np.testing.assert_array_equal(start.theta, x)
+    assert start.hessinv is None and not start.success
+
+
+def test_estimation_cache_skips_the_optimizer(tmp_path):
+    R = _returns(800)
+    x = [0.1, 0.012, 0.65, 0.05, 0.8, 0.02, 0.5]
+    cache = cg.EstimationCache(str(tmp_path / 'cache.sqlite'))
+    model = cg.cngarch(np.array(x), R, Qpers=True)
+    model.cache = cache
+    model.estimate()
+    assert model.stats.cachehits == 0 and len(cache) == 1
+
+    again = cg.cngarch(np.array(x), R.copy(), Qpers=True)
+    again.cache = pickle.loads(pickle.dumps(cache))
+    again.estimate()
+    assert again.stats.cachehits == 1 and again.stats.nfev == 0
+    np.testing.assert_array_equal(again.x, model.x)
+    assert again.loglikelihood == model.loglikelihood and again.success == model.success
+    np.testing.assert_array_equal(again._hessinv, model._hessinv)
+
+    # another series, specification or start is another estimation
+    for other in (cg.cngarch(np.array(x), R[1:], Qpers=True), cg.cngarch(np.array(x), R, Qpers=True, targetK=4.0),
+                  cg.cngarch(np.array(x)*1.01, R, Qpers=True)):
+        assert cache.key(other) != cache.key(model)
+
+    # the starts of parallel() found in the cache are not sent to the pool
+    thetas = model.genrandomthetas(SPECS[5][3], n=3, seed=3)
+    with cg.EstimationPool(2) as pool:
+        model.parallel(thetas, estpool=pool)
+        assert model.stats.cachehits == 0 and len(cache) == 4
+        first = model.x.copy()
+        model.parallel(thetas, estpool=pool)
+    assert model.stats.cachehits == 3 and model.stats.nfev == 0
+    np.testing.assert_array_equal(model.x, first)
+
+
+def test_estimation_cache_evicts_least_recently_used(tmp_path):
+    cache = cg.EstimationCache(str(tmp_path / 'cache.sqlite'), maxbytes=3*(40 + 7*8 + 32))
+    for index in range(3):
+        cache.store(f"{index:040d}", np.ones(7)*index, -index, True)
+    assert cache.lookup(f"{0:040d}") is not None
+    cache.store(f"{3:040d}", np.ones(7)*3, -3.0, False)
+    # entry 1 was the least recently used
+    assert len(cache) == 3 and cache.lookup(f"{1:040d}") is None
+    theta, loglikelihood, success, hessinv = cache.lookup(f"{3:040d}")
+    np.testing.assert_array_equal(theta, np.ones(7)*3)
+    assert loglikelihood == -3.0 and not success and hessinv is None
+
+
+def test_panelestimate_matches_serial_starts():
+    qqq = _returns(600)
+    prices = np.genfromtxt("./hd_EGHT.csv", delimiter=',', skip_header=1, usecols=(2,))
+    eght = np.diff(np.log(prices))[-400:]
+    model = cg.garch(np.array([0.1, 0.012, 0.95, 0.05]))
+    thetas = model.genrandomthetas(SPECS[0][3], n=3, seed=3)
+    table = cg.panelestimate(model, {'QQQ':qqq, 'EGHT':eght}, Ncores=2)
+
+    # the same panel as a 2D array, NaN padded
+    panel = np.full((600, 2), np.nan)
+    panel[:,0] = qqq
+    panel[-400:,1] = eght
+    with cg.EstimationPool(2) as pool:
+        arraytable = cg.panelestimate(model, panel, thetas, estpool=pool)
+
+    assert table['asset'] == ['QQQ', 'EGHT']
+    assert arraytable['asset'] == [0, 1]
+    for iasset, R in enumerate([qqq, eght]):
+        for istart in range(len(thetas)):
+            serial = cg.garch(thetas[istart,:].copy(), R)
+            serial.estimate()
+            np.testing.assert_array_equal(table['allthetas'][iasset,istart,:], serial.x)
+            assert table['allloglikelihoods'][iasset,istart] == serial.loglikelihood
+            assert table['allsuccess'][iasset,istart] == serial.success
+        best = np.argmin(table['allloglikelihoods'][iasset,:])
+        assert table['beststart'][iasset] == best
+        np.testing.assert_array_equal(table['theta'][iasset,:], table['allthetas'][iasset,best,:])
+        np.testing.assert_array_equal(arraytable['allthetas'][iasset], table['allthetas'][iasset])
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS)
+def test_simulate_matches_filter(cls, x, kwargs, thetarange):
+    R = _returns(1000)
+    model = cls(np.array(x), R, **kwargs)
+    returns, variances, components = model.simulate(4, 60, seed=7)
+    assert returns.shape == variances.shape == (4, 60)
+    assert (components is None) == (model._components==1)
+
+    again = model.simulate(4, 60, seed=7)
+    np.testing.assert_array_equal(again[0], returns)
+
+    # filtering history + simulated path recovers the simulated variances
+    for ipath in range(4):
+        extended = cls(np.array(x), np.r_[R, returns[ipath,:]], **kwargs)
+        extended.filter()
+        np.testing.assert_allclose(extended.vpath[-60:], variances[ipath,:], rtol=1e-9)
+        if components is not None:
+            np.testing.assert_allclose(extended.qpath[-60:], components[ipath,:], rtol=1e-9)
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS)
+def test_estimation_path_keeps_no_paths(cls, x, kwargs, thetarange):
+    model = cls(np.array(x), _returns(), **kwargs)
+    LL = model.filter()
+    vpath = model.vpath
+    np.testing.assert_allclose(model.filter(output="estimate"), LL, rtol=1e-12)
+    model.filter(output="gradient")
+    work = model._work
+    model.filter(output="gradient")
+    assert model.vpath is vpath
+    assert model._work is work
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", SPECS[1:2] + SPECS[4:5])
+def test_kngarch_matches_ngarch_and_cngarch(cls, x, kwargs, thetarange):
+    R = _returns()
+    model = cls(np.array(x), R)
+    generic = cg.kngarch(np.array(x), R, K=model._components)
+    assert generic.filter() == model.filter()
+    for path, genericpath in zip(model._componentpaths(), generic._componentpaths()):
+        np.testing.assert_array_equal(genericpath, path)
+    LL, grad = model.filter(output="gradient")
+    genericLL, genericgrad = generic.filter(output="gradient")
+    assert genericLL == LL
+    np.testing.assert_allclose(genericgrad, grad, rtol=1e-12, atol=1e-9)
+
+    model.forecast(250)
+    generic.forecast(250)
+    np.testing.assert_allclose(generic.vforecast, model.vforecast, rtol=1e-12)
+    np.testing.assert_array_equal(generic.simulate(3, 20, seed=1)[1], model.simulate(3, 20, seed=1)[1])
+
+
+@pytest.mark.parametrize("cls,x,kwargs,thetarange", KSPECS)
+def test_kngarch_termstructure_and_simulate(cls, x, kwargs, thetarange):
+    R = _returns(1000)
+    model = cls(np.array(x), R, **kwargs)
+    model.filter()
+    natural = model._natural()
+    var = natural[1]**2
+
+    # step by step forecast recursion, every component reverts to the next longer one
+    c = model.cpath[:,-1].copy()
+    expected = [c[0]]
+    for t in range(250):
+        c[-1] = var + natural[-3]*(c[-1] - var)
+        for k in range(len(c)-2, -1, -1):
+            c[k] = c[k+1] + natural[2+3*k]*(c[k] - c[k+1])
+        expected.append(c[0])
+    expected = np.array(expected)
+    horizons = np.array([0, 1, 5, 22, 250])
+    point, cumulative = model.termstructure(horizons)
+    np.testing.assert_allclose(point, expected[horizons], rtol=1e-10)
+    np.testing.assert_allclose(cumulative, [np.sum(expected[:h]) for h in horizons], rtol=1e-10)
+    paths, _ = model.termstructure(horizons, cstart=model.cpath[:,-5:])
+    np.testing.assert_array_equal(paths[-1], point)
+
+    returns, variances, components = model.simulate(4, 60, seed=7)
+    assert components.shape == (2, 4, 60)
+    extended = cls(np.array(x), np.r_[R, returns[0,:]], **kwargs)
+    extended.filter()
+    np.testing.assert_allclose(extended.vpath[-60:], variances[0,:], rtol=1e-9)
+    np.testing.assert_allclose(extended.cpath[1:,-60:], components[:,0,:], rtol=1e-9)
+
+
+def test_modelbank_matches_the_models():
+    # every class, on series of the same length starting on different days, in one bank padded to 3 components
+    R = _returns()
+    models = [cls(np.array(x), R[50*index:50*index+2000], **kwargs)
+              for index, (cls, x, kwargs, thetarange) in enumerate(SPECS + KSPECS)]
+    bank = cg.ModelBank.from_models(models)
+    assert len(bank) == len(models) and bank.components == 3
+    assert bank.persistence.shape == bank.alpha.shape == bank.gamma.shape == (len(models), 3)
+    bank.forecast(250)
+    assert bank.vpath.shape == (len(models), 2000) and bank.vforecast.shape == (len(models), 251)
+    for index, model in enumerate(models):
+        model.filter()
+        model.forecast(250)
+        np.testing.assert_array_equal(bank.vpath[index], model.vpath)
+        np.testing.assert_allclose(bank.loglikelihood[index], model.loglikelihood, rtol=1e-12)
+        np.testing.assert_allclose(bank.vforecast[index], model.vforecast, rtol=1e-12)
+        if model._components==2:
+            np.testing.assert_array_equal(bank.qpath[index], model.qpath)
+            np.testing.assert_allclose(bank.qforecast[index], model.qforecast, rtol=1e-12)
+        elif model._components==1:
+            np.testing.assert_allclose(bank.qpath[index], model._sg**2, rtol=1e-15)
+
+    assert np.array_equal(bank.filter(), bank.loglikelihood)
+    with pytest.raises(Exception):
+        bank.R = R[None,:]
+
+
+def test_import_is_lazy_and_kernels_are_cached():
+    code = "import sys, CNGARCH; print('sklearn' in sys.modules, 'scipy.optimize' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.split() == ['False', 'False']
+
+    from numba.core.registry import CPUDispatcher
+    module = sys.modules['CNGARCH.CNGARCH']
+    kernels = [kernel for kernel in vars(module).values() if isinstance(kernel, CPUDispatcher)]
+    assert len(kernels) == 14
+    for kernel in kernels:
+        assert kernel._cache.__class__.__name__ != 'NullCache', kernel